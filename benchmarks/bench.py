@@ -0,0 +1,239 @@
+# Benchmarks for Record operations against synthetic supply chains.
+#
+#   python3 -m benchmarks.bench --depth 1,5,10,20 --steps 3 --fan-in 1,3 --output bench.json
+#   python3 -m benchmarks.bench --compare bench.json
+#
+# Keys and certificates are generated in memory, so openssl is not needed.
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import tempfile
+import statistics
+import tracemalloc
+
+from cryptography.hazmat.primitives import serialization
+from ib1.provenance.signing import SignerInMemory
+
+from supplychain import Record
+from supplychain.certificates import CertificatesProviderSelfContainedRecord, CertificateCache
+from supplychain.certgen import generate_trust_framework, synthetic_members
+
+
+TRUST_FRAMEWORK_URL = "https://registry.core.trust.ib1.org/trust-framework"
+SCHEME_URL = "https://registry.core.trust.ib1.org/scheme/supply"
+
+# ---------------------------------------------------------------------------
+# Trust framework with in memory keys
+
+def make_trust_framework(member_count):
+    trust_framework = generate_trust_framework(synthetic_members(member_count), processes=0)
+    return trust_framework.ca_certificate, list(map(
+        lambda m: ([m.certificate, trust_framework.issuer_certificate], m.key),
+        trust_framework.members
+    ))
+
+# ---------------------------------------------------------------------------
+# Synthetic records
+
+def _add_layer_steps(record, steps_per_layer, inputs):
+    permission_id = record.add_step({
+        "type": "permission",
+        "scheme": SCHEME_URL,
+        "account": "benchmark",
+        "allows": {"licences": [SCHEME_URL + "/licence/supply-data/2024-12-05"]},
+        "expires": "2030-01-01T00:00:00Z"
+    })
+    origin_id = record.add_step({
+        "type": "origin",
+        "scheme": SCHEME_URL,
+        "sourceType": SCHEME_URL + "/source-type/Meter",
+        "origin": "https://meter.example.com/",
+        "external": False
+    })
+    ids = inputs + [origin_id]
+    for n in range(max(0, steps_per_layer - 3)):
+        ids = [record.add_step({
+            "type": "process",
+            "scheme": SCHEME_URL,
+            "inputs": ids,
+            "process": SCHEME_URL + "/process/manufacture/2024-12-05",
+            "permissions": [permission_id]
+        })]
+    return record.add_step({
+        "type": "transfer",
+        "scheme": SCHEME_URL,
+        "of": ids[0],
+        "to": "https://directory.core.trust.ib1.org/member/100000",
+        "licence": SCHEME_URL + "/licence/supply-data/2024-12-05",
+        "permissions": [permission_id]
+    })
+
+
+def make_chain(signers, depth, steps_per_layer, fan_in):
+    # Each layer wraps the previous one, and merges fan_in - 1 separately
+    # signed single layer records with add_record()
+    encoded = None
+    transfer_ids = []
+    for level in range(depth):
+        record = Record(TRUST_FRAMEWORK_URL, encoded)
+        inputs = []
+        for t in transfer_ids:
+            inputs.append(record.add_step({"type": "receipt", "transfer": t}))
+        transfer_ids = []
+        for branch in range(fan_in - 1):
+            other = Record(TRUST_FRAMEWORK_URL)
+            transfer_ids.append(_add_layer_steps(other, steps_per_layer, []))
+            record.add_record(other.sign(signers[(level + branch + 1) % len(signers)]))
+        transfer_ids.append(_add_layer_steps(record, steps_per_layer, inputs))
+        if level == depth - 1:
+            return record, signers[level % len(signers)]
+        encoded = record.sign(signers[level % len(signers)]).encoded()
+
+# ---------------------------------------------------------------------------
+# Measurement
+
+def measure(operation, repeat):
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+    # Memory measured on a separate run, as tracing slows everything down
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    start_size, _ = tracemalloc.get_traced_memory()
+    result = operation()
+    end_size, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # Memory blocks allocated by the operation which are still live
+    # afterwards, including its result. Blocks freed before the end aren't
+    # counted, so this is not the number of allocations made.
+    retained_blocks = sum(map(lambda s: max(0, s.count_diff), after.compare_to(before, "lineno")))
+    del result
+    return {
+        "seconds_min": min(times),
+        "seconds_median": statistics.median(times),
+        "peak_bytes": peak - start_size,
+        "retained_bytes": end_size - start_size,
+        "retained_blocks": retained_blocks
+    }
+
+
+def run_case(signers, ca_file, depth, steps_per_layer, fan_in, repeat):
+    unsigned, signer = make_chain(signers, depth, steps_per_layer, fan_in)
+    signed = unsigned.sign(signer)
+    encoded_json = json.dumps(signed.encoded())
+    # A fresh provider and certificate cache for every verify, so each run
+    # measures the full cost
+    def verify():
+        record = Record(TRUST_FRAMEWORK_URL, signed.encoded())
+        record.verify(CertificatesProviderSelfContainedRecord(ca_file, CertificateCache()))
+        return record
+    def verify_compact():
+        record = Record(TRUST_FRAMEWORK_URL, signed.encoded(), compact=True)
+        record.verify(CertificatesProviderSelfContainedRecord(ca_file, CertificateCache()))
+        return record
+    verified = verify()
+    operations = {
+        "sign": lambda: unsigned.sign(signer),
+        "encode": lambda: json.dumps(signed.encoded()),
+        "parse": lambda: Record(TRUST_FRAMEWORK_URL, json.loads(encoded_json)),
+        "verify": verify,
+        "verify_compact": verify_compact,
+        "decoded": verified.decoded,
+        "to_graphviz": verified.to_graphviz
+    }
+    results = []
+    for name, operation in operations.items():
+        result = {
+            "depth": depth,
+            "steps": steps_per_layer,
+            "fan_in": fan_in,
+            "operation": name,
+            "record_bytes": len(encoded_json),
+            "step_count": len(verified.decoded())
+        }
+        result.update(measure(operation, repeat))
+        results.append(result)
+    return results
+
+# ---------------------------------------------------------------------------
+
+def compare(results, baseline_file, threshold):
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    key = lambda r: (r["depth"], r["steps"], r["fan_in"], r["operation"])
+    previous = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        p = previous.get(key(r))
+        if p is None or p["seconds_min"] == 0:
+            continue
+        ratio = r["seconds_min"] / p["seconds_min"]
+        if ratio > threshold:
+            regressions.append((key(r), ratio))
+    return regressions
+
+
+def _int_list(value):
+    return list(map(int, value.split(",")))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark provenance Record operations")
+    parser.add_argument("--depth", type=_int_list, default=[1, 5, 10, 20])
+    parser.add_argument("--steps", type=_int_list, default=[3])
+    parser.add_argument("--fan-in", type=_int_list, default=[1, 3])
+    parser.add_argument("--members", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="compare with results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio reported as a regression")
+    args = parser.parse_args(argv)
+
+    ca_cert, members = make_trust_framework(args.members)
+    with tempfile.TemporaryDirectory() as directory:
+        # The certificate provider reads the root CA from a file
+        ca_file = os.path.join(directory, "ca.pem")
+        with open(ca_file, "wb") as f:
+            f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
+        provider = CertificatesProviderSelfContainedRecord(ca_file)
+        signers = list(map(lambda m: SignerInMemory(provider, m[0], m[1]), members))
+        results = []
+        print("depth steps fan_in operation        steps  bytes      min ms   median ms  peak KB  blocks")
+        for depth in args.depth:
+            for steps_per_layer in args.steps:
+                for fan_in in args.fan_in:
+                    for r in run_case(signers, ca_file, depth, steps_per_layer, fan_in, args.repeat):
+                        results.append(r)
+                        print("%5d %5d %6d %-14s %7d %8d %10.3f %10.3f %8d %7d" % (
+                            r["depth"], r["steps"], r["fan_in"], r["operation"], r["step_count"], r["record_bytes"],
+                            r["seconds_min"] * 1000, r["seconds_median"] * 1000, r["peak_bytes"] // 1024, r["retained_blocks"]))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "results": results
+            }, f, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for (depth, steps_per_layer, fan_in, operation), ratio in regressions:
+            print("REGRESSION depth=%d steps=%d fan_in=%d %s: %.2fx slower" % (depth, steps_per_layer, fan_in, operation, ratio))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,45 +1,48 @@
+import sys
 import json
+import argparse
 
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization
 
-from ib1.provenance import Record
-from ib1.provenance.signing import SignerFiles, SignerInMemory
-from ib1.provenance.certificates import (
-    CertificatesProviderSelfContainedRecord,
-    CertificatesProviderLocal,
-)
+from supplychain import Record, VerifiedLayerCache
+from ib1.provenance.signing import SignerInMemory
+from ib1.provenance.certificates import CertificatesProviderLocal
+from supplychain.certificates import CertificatesProviderSelfContainedRecord
+from supplychain.signers import SignerRegistry
+from supplychain.instrument import add_hook, set_participant, ProfileSummary, JsonLinesExporter
 
 
 TRUST_FRAMEWORK_URL = "https://registry.core.trust.ib1.org/trust-framework"
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", action="store_true", help="print where time is spent by each participant to stderr")
+    parser.add_argument("--profile-output", help="write timing spans to this file as JSON lines")
+    args = parser.parse_args()
+    profile = None
+    if args.profile:
+        profile = ProfileSummary()
+        add_hook(profile)
+    profile_output = None
+    if args.profile_output is not None:
+        profile_output = open(args.profile_output, "w", encoding="utf-8")
+        add_hook(JsonLinesExporter(profile_output))
+
     # Certificate provider
     certificate_provider = CertificatesProviderSelfContainedRecord(
         "certs/4-signing-ca-cert.pem"
     )
+    # Signed layers already verified by an earlier hop are not checked again
+    verification_cache = VerifiedLayerCache()
 
-    # Load signers
-    signers = {}
-    signer_file_list = [
-        "6-industrial-metering-company",
-        "7-nitrogen-fertiliser-products",
-        "8-agricultural-wholesale-supplies",
-        "9-precise-farm-automation-co",
-        "10-rosemary-accountancy-software",
-        "11-sustainable-farm-systems",
-        "12-green-bank-of-london"
-    ]
-    for n in signer_file_list:
-        signers[n] = SignerFiles(
-                certificate_provider,
-                "certs/"+n+"-cert-bundle.pem",
-                "certs/"+n+"-key.pem"
-            )
+    # Signers, read from the keystore when first used
+    signers = SignerRegistry(certificate_provider, "certs")
 
     # -----------------------------------------------------------------------
     # ===== Metering provider
+    set_participant("metering")
     metering_record = Record(TRUST_FRAMEWORK_URL)
     # - Permission step to record consent by end user
     metering_permission_id = metering_record.add_step(
@@ -102,7 +105,8 @@ if __name__ == "__main__":
 
     # -----------------------------------------------------------------------
     # ===== Manufacturer
-    manufacturer_record = Record(TRUST_FRAMEWORK_URL, metering_data_attachment)
+    set_participant("manufacturer")
+    manufacturer_record = Record(TRUST_FRAMEWORK_URL, metering_data_attachment, verification_cache)
 
     manufacturer_record.verify(certificate_provider)
 
@@ -215,7 +219,8 @@ if __name__ == "__main__":
 
     # -----------------------------------------------------------------------
     # ===== Wholesaler
-    wholesaler_record = Record(TRUST_FRAMEWORK_URL, manufacturer_data_attachment)
+    set_participant("wholesaler")
+    wholesaler_record = Record(TRUST_FRAMEWORK_URL, manufacturer_data_attachment, verification_cache)
 
     wholesaler_record.verify(certificate_provider)
 
@@ -266,7 +271,8 @@ if __name__ == "__main__":
 
     # -----------------------------------------------------------------------
     # ===== Farm management system
-    farm_management_system_record = Record(TRUST_FRAMEWORK_URL, wholesaler_data_attachment)
+    set_participant("farm-management-system")
+    farm_management_system_record = Record(TRUST_FRAMEWORK_URL, wholesaler_data_attachment, verification_cache)
 
     farm_management_system_record.verify(certificate_provider)
 
@@ -335,6 +341,7 @@ if __name__ == "__main__":
 
     # -----------------------------------------------------------------------
     # ===== Accounting software getting data from the bank
+    set_participant("accountants")
 
     accountants_record = Record(TRUST_FRAMEWORK_URL)
 
@@ -400,12 +407,13 @@ if __name__ == "__main__":
 
     # -----------------------------------------------------------------------
     # ===== Sustainability accounting platform
+    set_participant("sustainability-accounting-platform")
 
-    sustainability_accounting_platform_record = Record(TRUST_FRAMEWORK_URL, farm_management_system_data_attachment)
+    sustainability_accounting_platform_record = Record(TRUST_FRAMEWORK_URL, farm_management_system_data_attachment, verification_cache)
 
     sustainability_accounting_platform_record.verify(certificate_provider)
 
-    sustainability_accounting_platform_record.add_record(Record(TRUST_FRAMEWORK_URL, accountants_data_attachment))
+    sustainability_accounting_platform_record.add_record(Record(TRUST_FRAMEWORK_URL, accountants_data_attachment, verification_cache))
 
     sustainability_accounting_platform_receipt_id = sustainability_accounting_platform_record.add_step(
         {
@@ -480,8 +488,9 @@ if __name__ == "__main__":
 
     # -----------------------------------------------------------------------
     # ===== Farm management system
+    set_participant("bank")
 
-    bank_record = Record(TRUST_FRAMEWORK_URL, sustainability_accounting_platform_data_attachment)
+    bank_record = Record(TRUST_FRAMEWORK_URL, sustainability_accounting_platform_data_attachment, verification_cache)
 
     bank_receipt_id = bank_record.add_step(
         {
@@ -494,6 +503,7 @@ if __name__ == "__main__":
     # -----------------------------------------------------------------------
 
     # ===== Final record after all the the steps have been added
+    set_participant("output")
     final_record = bank_record_signed
 
     # Print records
@@ -503,5 +513,9 @@ if __name__ == "__main__":
     final_record.verify(certificate_provider)
     print(json.dumps(final_record.decoded(), indent=2).encode("utf-8").decode("utf-8"))
     print("----- Graphviz dot file -----")
-    print(final_record.to_graphviz())
+    final_record.write_graphviz(sys.stdout)
 
+    if profile is not None:
+        profile.report(sys.stderr)
+    if profile_output is not None:
+        profile_output.close()
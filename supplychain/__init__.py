@@ -0,0 +1,2 @@
+from .record import Record  # noqa: F401
+from .cache import VerifiedLayerCache  # noqa: F401
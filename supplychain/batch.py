@@ -0,0 +1,177 @@
+import copy
+import time
+import collections
+import concurrent.futures
+
+from ib1.provenance.signing import SignerFiles
+
+from .record import Record
+from .certificates import CertificatesProviderSelfContainedRecord
+
+# ---------------------------------------------------------------------------
+
+class StepReference:
+
+    # Placeholder in a step template for the identifier of an earlier step
+    # in the same template, given by its index in the template.
+
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+# ---------------------------------------------------------------------------
+
+class BatchSigner:
+
+    # Signs many single layer records with one signer, for example a record
+    # per meter per metering period. Each template is a list of steps, as
+    # would be passed to Record.add_step(), where StepReference(n) stands for
+    # the id of the nth step of that template. sign() is a generator of
+    # encoded records in the same order as the templates.
+    #
+    # The signer is set up once per batch: its certificates section is
+    # encoded with the first record and shared by the rest. With processes
+    # set, records are signed on a process pool; signer_factory must then be
+    # a picklable callable returning the signer, as private keys can't be
+    # sent to another process. It's called once per worker.
+    #
+    # After a batch, count and seconds give the throughput.
+
+    def __init__(self, trust_framework, signer=None, signer_factory=None, processes=None, chunk_size=64):
+        if (signer is None) == (signer_factory is None):
+            raise Exception("BatchSigner needs exactly one of signer or signer_factory")
+        if processes and signer_factory is None:
+            raise Exception("BatchSigner needs a signer_factory to sign in other processes")
+        self.trust_framework = trust_framework
+        self._signer = signer
+        self._signer_factory = signer_factory
+        self._processes = processes
+        self._chunk_size = chunk_size
+        self.count = 0
+        self.seconds = 0.0
+
+    def throughput(self):
+        if self.seconds == 0:
+            return 0.0
+        return self.count / self.seconds
+
+    def sign(self, templates):
+        self.count = 0
+        self.seconds = 0.0
+        start = time.perf_counter()
+        if self._processes:
+            signed = self._sign_on_pool(templates)
+        else:
+            signer = self._signer if self._signer is not None else self._signer_factory()
+            signed = map(_TemplateSigner(self.trust_framework, signer).sign, templates)
+        for encoded in signed:
+            self.count += 1
+            self.seconds = time.perf_counter() - start
+            yield encoded
+
+    def _sign_on_pool(self, templates):
+        # Keep a bounded number of chunks in flight, so templates are read
+        # and records are returned as a stream
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._processes,
+            initializer=_initialise_worker,
+            initargs=(self.trust_framework, self._signer_factory)
+        )
+        in_flight = collections.deque()
+        with executor:
+            for chunk in _chunks(templates, self._chunk_size):
+                in_flight.append(executor.submit(_sign_chunk_in_worker, chunk))
+                if len(in_flight) >= self._processes * 2:
+                    yield from in_flight.popleft().result()
+            while in_flight:
+                yield from in_flight.popleft().result()
+
+# ---------------------------------------------------------------------------
+
+class _TemplateSigner:
+
+    def __init__(self, trust_framework, signer):
+        self.trust_framework = trust_framework
+        self._signer = signer
+        self._certificates = None
+        self._signer_without_certificates = _SignerWithoutCertificates(signer)
+
+    def sign(self, template):
+        record = Record(self.trust_framework)
+        ids = []
+        for step in template:
+            ids.append(record.add_step(_resolve_references(step, ids)))
+        if self._certificates is None:
+            encoded = record.sign(self._signer).encoded()
+            self._certificates = encoded.get("certificates", {})
+        else:
+            # Same signer, so the certificates section is the same for every record
+            encoded = record.sign(self._signer_without_certificates).encoded()
+            if self._certificates:
+                # In the same order as Record.sign(), certificates before the
+                # steps, so a RecordStreamReader can verify layers as it reads
+                encoded = {
+                    "ib1:provenance": encoded["ib1:provenance"],
+                    "origins": encoded["origins"],
+                    "certificates": copy.deepcopy(self._certificates),
+                    "steps": encoded["steps"]
+                }
+        return encoded
+
+
+class _SignerWithoutCertificates:
+
+    def __init__(self, signer):
+        self._signer = signer
+        self._serial = signer.serial()
+
+    def serial(self):
+        return self._serial
+
+    def certificates_for_record(self):
+        return None
+
+    def sign(self, data):
+        return self._signer.sign(data)
+
+
+def _resolve_references(value, ids):
+    if isinstance(value, StepReference):
+        return ids[value.index]
+    if isinstance(value, dict):
+        return {k: _resolve_references(v, ids) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_resolve_references(v, ids) for v in value]
+    return value
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def signer_from_files(root_ca_certificate, certificate_file, key_file):
+    # Module level, so functools.partial(signer_from_files, ...) can be used
+    # as a signer_factory for a process pool
+    certificate_provider = CertificatesProviderSelfContainedRecord(root_ca_certificate)
+    return SignerFiles(certificate_provider, certificate_file, key_file)
+
+# ---------------------------------------------------------------------------
+
+_worker_template_signer = None
+
+
+def _initialise_worker(trust_framework, signer_factory):
+    global _worker_template_signer
+    _worker_template_signer = _TemplateSigner(trust_framework, signer_factory())
+
+
+def _sign_chunk_in_worker(chunk):
+    return list(map(_worker_template_signer.sign, chunk))
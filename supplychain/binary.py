@@ -0,0 +1,401 @@
+# Compact binary encoding for encoded provenance records.
+#
+# The record is written as CBOR (RFC 8949). Steps are stored as CBOR maps
+# rather than base64 encoded JSON, signatures and certificates as raw bytes,
+# and strings which occur more than once in the record (URLs, step ids,
+# serials, certificates) are stored once and then referred to by index,
+# using the registered stringref tags (http://cbor.schmorp.de/stringref).
+#
+# decode_record() reproduces the encoded record exactly, so the data signed
+# is unchanged and the record verifies as before. Any step, signature or
+# certificate which would not round trip exactly is stored verbatim.
+#
+#   256([format version, {top level of record ...}])
+#
+# In the top level map, "steps" is the nested steps array, where a step is
+# a map (the decoded step), bytes (the JSON of a step which doesn't
+# re-encode exactly) or text (the step exactly as in the record), and the
+# last element of each array is the signature block. Under "certificates",
+# in either form, bytes are DER encoded certificates. Within tag 256, each
+# text or byte string long enough to be worth referring to is numbered in
+# the order it appears, and tag 25 refers to a string by its number.
+
+import json
+import base64
+import struct
+
+from .certificates import is_structured_certificates
+
+
+BINARY_FORMAT_VERSION = 2
+
+MEDIA_TYPE = "application/vnd.ib1.provenance+cbor"
+
+TAG_STRING_REFERENCE = 25
+TAG_STRING_NAMESPACE = 256
+
+# ---------------------------------------------------------------------------
+
+def encode_record(record):
+    # record is the encoded form, as returned by Record.encoded()
+    top = {}
+    for key, value in record.items():
+        match key:
+            case "steps":
+                top[key] = _steps_for_binary(value)
+            case "certificates":
+                top[key] = _certificates_for_binary(value)
+            case _:
+                top[key] = value
+    encoder = _Encoder()
+    encoder.encode_tag(TAG_STRING_NAMESPACE)
+    encoder.encode_array_head(2)
+    encoder.encode(BINARY_FORMAT_VERSION)
+    encoder.encode(top)
+    return bytes(encoder.output)
+
+
+def decode_record(data):
+    # The record is a stringref namespace
+    namespaced = bytes(data[:3]) == b"\xd9\x01\x00"
+    decoder = _Decoder(data)
+    decoded = decoder.decode()
+    if decoder.offset != len(data):
+        raise Exception("Unexpected data after binary provenance record")
+    match decoded:
+        case [version, dict(top)] if namespaced and version == BINARY_FORMAT_VERSION:
+            pass
+        case [int(version), *_] if version != BINARY_FORMAT_VERSION:
+            raise Exception("Cannot decode binary provenance record format version: "+str(version))
+        case _:
+            raise Exception("Not a binary provenance record")
+    record = {}
+    for key, value in top.items():
+        match key:
+            case "steps":
+                record[key] = _steps_from_binary(value)
+            case "certificates":
+                record[key] = _certificates_from_binary(value)
+            case _:
+                record[key] = value
+    return record
+
+# ---------------------------------------------------------------------------
+
+def _encode_step(step):
+    return base64.urlsafe_b64encode(json.dumps(step, separators=(",", ":")).encode("utf-8")).decode("utf-8")
+
+
+def _steps_for_binary(container):
+    *data, sig_block = container
+    output = []
+    for e in data:
+        if not isinstance(e, str):
+            output.append(_steps_for_binary(e))
+        else:
+            output.append(_step_for_binary(e))
+    container_format_version, serial, sign_timestamp, signature = sig_block
+    try:
+        raw_signature = base64.urlsafe_b64decode(signature)
+        if base64.urlsafe_b64encode(raw_signature).decode("utf-8") == signature:
+            signature = raw_signature
+    except ValueError:
+        pass
+    output.append([container_format_version, serial, sign_timestamp, signature])
+    return output
+
+
+def _step_for_binary(encoded_step):
+    try:
+        raw = base64.urlsafe_b64decode(encoded_step)
+    except ValueError:
+        return _Verbatim(encoded_step)
+    if base64.urlsafe_b64encode(raw).decode("utf-8") != encoded_step:
+        return _Verbatim(encoded_step)
+    try:
+        step = json.loads(raw)
+        if isinstance(step, dict) and _encode_step(step) == encoded_step and _encodable(step):
+            return step
+    except ValueError:
+        pass
+    return raw
+
+
+def _steps_from_binary(container):
+    *data, sig_block = container
+    output = []
+    for e in data:
+        if isinstance(e, list):
+            output.append(_steps_from_binary(e))
+        elif isinstance(e, dict):
+            output.append(_encode_step(e))
+        elif isinstance(e, bytes):
+            output.append(base64.urlsafe_b64encode(e).decode("utf-8"))
+        else:
+            output.append(e)
+    container_format_version, serial, sign_timestamp, signature = sig_block
+    if isinstance(signature, bytes):
+        signature = base64.urlsafe_b64encode(signature).decode("utf-8")
+    output.append([container_format_version, serial, sign_timestamp, signature])
+    return output
+
+
+def _certificates_for_binary(certificates):
+    if not isinstance(certificates, dict):
+        return certificates
+    if is_structured_certificates(certificates):
+        der = {}
+        for fingerprint, encoded in certificates["der"].items():
+            try:
+                raw = base64.b64decode(encoded, validate=True)
+                if base64.b64encode(raw).decode("utf-8") == encoded:
+                    encoded = raw
+            except ValueError:
+                pass
+            der[fingerprint] = encoded
+        return {**certificates, "der": der}
+    output = {}
+    for serial, path in certificates.items():
+        if isinstance(path, list) and path and isinstance(path[0], str):
+            der = _der_from_pem(path[0])
+            if der is not None:
+                path = [der] + path[1:]
+        output[serial] = path
+    return output
+
+
+def _certificates_from_binary(certificates):
+    if not isinstance(certificates, dict):
+        return certificates
+    if is_structured_certificates(certificates):
+        der = {}
+        for fingerprint, encoded in certificates["der"].items():
+            if isinstance(encoded, bytes):
+                encoded = base64.b64encode(encoded).decode("utf-8")
+            der[fingerprint] = encoded
+        return {**certificates, "der": der}
+    output = {}
+    for serial, path in certificates.items():
+        if isinstance(path, list) and path and isinstance(path[0], bytes):
+            path = [_pem_from_der(path[0])] + path[1:]
+        output[serial] = path
+    return output
+
+
+PEM_BEGIN = "-----BEGIN CERTIFICATE-----\n"
+PEM_END = "-----END CERTIFICATE-----\n"
+
+
+def _pem_from_der(der):
+    body = base64.b64encode(der).decode("ascii")
+    lines = [body[i:i+64] for i in range(0, len(body), 64)]
+    return PEM_BEGIN + "\n".join(lines) + "\n" + PEM_END
+
+
+def _der_from_pem(pem):
+    if not (pem.startswith(PEM_BEGIN) and pem.endswith(PEM_END)):
+        return None
+    try:
+        der = base64.b64decode(pem[len(PEM_BEGIN):-len(PEM_END)], validate=False)
+    except ValueError:
+        return None
+    if _pem_from_der(der) != pem:
+        return None
+    return der
+
+# ---------------------------------------------------------------------------
+
+class _Verbatim(str):
+    # A step kept exactly as it appears in the record
+    pass
+
+
+def _encodable(value):
+    # Whether a JSON value will be reproduced exactly by the CBOR encoding
+    if isinstance(value, bool) or value is None or isinstance(value, (str, float)):
+        return True
+    if isinstance(value, int):
+        return -(2**64) <= value < 2**64
+    if isinstance(value, list):
+        return all(map(_encodable, value))
+    if isinstance(value, dict):
+        return all(map(lambda k: isinstance(k, str), value.keys())) and all(map(_encodable, value.values()))
+    return False
+
+
+def _string_numbered(length, next_index):
+    # Whether a string is given the next number in a stringref namespace:
+    # only strings longer than a reference to them are numbered
+    if next_index < 24:
+        return length >= 3
+    if next_index < 0x100:
+        return length >= 4
+    if next_index < 0x10000:
+        return length >= 5
+    if next_index < 0x100000000:
+        return length >= 7
+    return length >= 11
+
+# ---------------------------------------------------------------------------
+# Minimal CBOR, covering the types used in JSON plus byte strings
+
+class _Encoder:
+
+    # data attributes:
+    #   _strings -- text or byte string -> its number in the stringref namespace
+    #   _next_index -- number of strings numbered so far
+
+    def __init__(self):
+        self.output = bytearray()
+        self._strings = {}
+        self._next_index = 0
+
+    def _head(self, major, value):
+        if value < 24:
+            self.output.append((major << 5) | value)
+        elif value < 0x100:
+            self.output.append((major << 5) | 24)
+            self.output.append(value)
+        elif value < 0x10000:
+            self.output.append((major << 5) | 25)
+            self.output += struct.pack(">H", value)
+        elif value < 0x100000000:
+            self.output.append((major << 5) | 26)
+            self.output += struct.pack(">I", value)
+        else:
+            self.output.append((major << 5) | 27)
+            self.output += struct.pack(">Q", value)
+
+    def encode_array_head(self, length):
+        self._head(4, length)
+
+    def encode_tag(self, tag):
+        self._head(6, tag)
+
+    def _encode_string(self, major, value, encoded):
+        index = self._strings.get(value)
+        if index is not None:
+            self._head(6, TAG_STRING_REFERENCE)
+            self._head(0, index)
+            return
+        self._head(major, len(encoded))
+        self.output += encoded
+        # The decoder numbers strings by the same rule
+        if _string_numbered(len(encoded), self._next_index):
+            self._strings[value] = self._next_index
+            self._next_index += 1
+
+    def encode(self, value):
+        if value is None:
+            self.output.append(0xf6)
+        elif value is True:
+            self.output.append(0xf5)
+        elif value is False:
+            self.output.append(0xf4)
+        elif isinstance(value, int):
+            if value >= 0:
+                self._head(0, value)
+            else:
+                self._head(1, -1 - value)
+        elif isinstance(value, float):
+            self.output.append(0xfb)
+            self.output += struct.pack(">d", value)
+        elif isinstance(value, bytes):
+            self._encode_string(2, value, value)
+        elif isinstance(value, str):
+            self._encode_string(3, str(value), value.encode("utf-8"))
+        elif isinstance(value, list):
+            self._head(4, len(value))
+            for v in value:
+                self.encode(v)
+        elif isinstance(value, dict):
+            self._head(5, len(value))
+            for k, v in value.items():
+                self.encode(k)
+                self.encode(v)
+        else:
+            raise Exception("Cannot encode value of type "+type(value).__name__)
+
+
+class _Decoder:
+
+    # data attributes:
+    #   _strings -- strings numbered in the current stringref namespace, or None outside one
+
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self.offset = 0
+        self._strings = None
+
+    def _read(self, length):
+        if self.offset + length > len(self._data):
+            raise Exception("Truncated binary provenance record")
+        chunk = self._data[self.offset:self.offset + length]
+        self.offset += length
+        return chunk
+
+    def _argument(self, info):
+        if info < 24:
+            return info
+        match info:
+            case 24:
+                return self._read(1)[0]
+            case 25:
+                return struct.unpack(">H", self._read(2))[0]
+            case 26:
+                return struct.unpack(">I", self._read(4))[0]
+            case 27:
+                return struct.unpack(">Q", self._read(8))[0]
+        raise Exception("Unsupported CBOR length encoding in binary provenance record")
+
+    def _numbered(self, string, length):
+        if self._strings is not None and _string_numbered(length, len(self._strings)):
+            self._strings.append(string)
+        return string
+
+    def decode(self):
+        initial = self._read(1)[0]
+        major = initial >> 5
+        info = initial & 0x1f
+        if major == 7:
+            match info:
+                case 20:
+                    return False
+                case 21:
+                    return True
+                case 22:
+                    return None
+                case 27:
+                    return struct.unpack(">d", self._read(8))[0]
+            raise Exception("Unsupported CBOR simple value in binary provenance record")
+        argument = self._argument(info)
+        match major:
+            case 0:
+                return argument
+            case 1:
+                return -1 - argument
+            case 2:
+                return self._numbered(bytes(self._read(argument)), argument)
+            case 3:
+                return self._numbered(str(self._read(argument), "utf-8"), argument)
+            case 4:
+                return [self.decode() for n in range(argument)]
+            case 5:
+                output = {}
+                for n in range(argument):
+                    key = self.decode()
+                    output[key] = self.decode()
+                return output
+            case 6:
+                if argument == TAG_STRING_NAMESPACE:
+                    outer = self._strings
+                    self._strings = []
+                    value = self.decode()
+                    self._strings = outer
+                    return value
+                if argument == TAG_STRING_REFERENCE:
+                    index = self.decode()
+                    if self._strings is None or not isinstance(index, int) or not (0 <= index < len(self._strings)):
+                        raise Exception("Bad string reference in binary provenance record")
+                    return self._strings[index]
+                raise Exception("Unsupported CBOR tag in binary provenance record: "+str(argument))
@@ -0,0 +1,180 @@
+import os
+import hmac
+import json
+import hashlib
+import threading
+import collections
+
+
+# ---------------------------------------------------------------------------
+
+def layer_digest(trust_framework, container, memo=None):
+    # Content address of a signed layer. Nested layers are hashed first and
+    # only their digests are fed into the enclosing layer, so with a memo
+    # every layer of a record is hashed exactly once.
+    key = id(container)
+    if memo is not None and key in memo:
+        return memo[key]
+    *data, sig_block = container
+    h = hashlib.sha256(trust_framework.encode("utf-8"))
+    for e in data:
+        if isinstance(e, str):
+            h.update(b".s")
+            h.update(e.encode("utf-8"))
+        else:
+            h.update(b".c")
+            h.update(layer_digest(trust_framework, e, memo))
+    h.update(b".!")
+    h.update(json.dumps(sig_block, separators=(",", ":")).encode("utf-8"))
+    digest = h.digest()
+    if memo is not None:
+        memo[key] = digest
+    return digest
+
+
+def provider_identity(certificate_provider):
+    # Identifies the root CA certificates a provider checks chains against,
+    # so layers verified with one set of roots are never taken as verified
+    # with another. None if the provider can't identify its roots, and then
+    # no cache can be used with it.
+    identity = getattr(certificate_provider, "identity", None)
+    return identity() if identity is not None else None
+
+# ---------------------------------------------------------------------------
+
+class LRUCache:
+
+    # Thread safe mapping with a bounded number of entries, evicting the least
+    # recently used entry first, and counting lookups.
+    #
+    # data attributes:
+    #   _entries -- OrderedDict of key -> value, least recently used first
+
+    def __init__(self, max_entries):
+        if max_entries < 1:
+            raise Exception("Cache needs room for at least one entry")
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+# ---------------------------------------------------------------------------
+
+class VerifiedLayerCache:
+
+    # Remembers the signer information of signed layers whose signature has
+    # been checked, keyed by the provider_identity() of the provider which
+    # checked it, the certificates.chain_digest() of the signer's chain in
+    # the record, and the layer_digest(). Signatures are checked against the
+    # certificate chain at the time of signing, so an entry never goes stale.
+    #
+    # Entries in the on-disk store are authenticated with an HMAC using
+    # secret, which must be kept somewhere other than the directory. Entries
+    # which don't authenticate are ignored, so anyone able to write to the
+    # directory can't mark layers as verified.
+    #
+    # data attributes:
+    #   _entries -- LRUCache of provider identity + chain digest + layer digest -> signer info
+    #   _directory -- optional directory for the on-disk store
+    #   _secret -- HMAC key for the on-disk store
+
+    def __init__(self, max_entries=4096, directory=None, secret=None):
+        self._entries = LRUCache(max_entries)
+        self._directory = directory
+        self._secret = secret
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            if not secret:
+                raise Exception("On-disk verified layer cache needs a secret")
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, identity, chain, digest):
+        if identity is None:
+            return None
+        key = identity + chain + digest
+        signer_info = self._entries.get(key)
+        if signer_info is None:
+            signer_info = self._read_from_disk(key)
+            if signer_info is not None:
+                self._entries.put(key, signer_info)
+        if signer_info is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return signer_info
+
+    def put(self, identity, chain, digest, signer_info):
+        if identity is None:
+            return
+        key = identity + chain + digest
+        self._entries.put(key, signer_info)
+        self._write_to_disk(key, signer_info)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, identity_chain_and_digest):
+        identity, chain, digest = identity_chain_and_digest
+        return identity is not None and identity + chain + digest in self._entries
+
+    def _filename(self, key):
+        return os.path.join(self._directory, hashlib.sha256(key).hexdigest() + ".json")
+
+    def _mac(self, key, signer_info_json):
+        return hmac.new(self._secret, key + b"." + signer_info_json.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def _read_from_disk(self, key):
+        if self._directory is None:
+            return None
+        try:
+            with open(self._filename(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not (isinstance(entry, dict) and isinstance(entry.get("signed"), str) and isinstance(entry.get("mac"), str)):
+            return None
+        if not hmac.compare_digest(self._mac(key, entry["signed"]), entry["mac"]):
+            return None
+        return json.loads(entry["signed"])
+
+    def _write_to_disk(self, key, signer_info):
+        if self._directory is None:
+            return
+        filename = self._filename(key)
+        signer_info_json = json.dumps(signer_info, sort_keys=True)
+        # Write then rename, so concurrent readers never see a partial file
+        temporary = filename + "." + str(os.getpid()) + "." + str(threading.get_ident())
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump({"signed": signer_info_json, "mac": self._mac(key, signer_info_json)}, f)
+        os.replace(temporary, filename)
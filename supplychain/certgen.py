@@ -0,0 +1,245 @@
+# Generates the certificates of a trust framework for the supply chain
+# scenarios, replacing scripts/certmaker.sh without needing openssl:
+#
+#   4. Core Trust Framework Signing CA
+#       5. Core Trust Framework Signing Issuer
+#            6... member certificates
+#
+# Member certificates have the same subject and extensions as the roles in
+# scripts/roles.cnf (member URL, IB1 roles and application). Member keys
+# and certificates are made in a process pool for large numbers of members.
+#
+#   python3 -m supplychain.certgen certs
+#   python3 -m supplychain.certgen --members 5000 certs
+#
+# Files are written with the names used by certmaker.sh, so SignerFiles and
+# main.py can use them unchanged, or signers can be made in memory.
+
+import os
+import sys
+import argparse
+import datetime
+import concurrent.futures
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from ib1.provenance.signing import SignerInMemory
+from ib1.provenance.certificates import CertExtUTF8Sequence, OID_IB1_ROLES, OID_IB1_APPLICATION
+import asn1crypto.core as asn1
+
+
+DIRECTORY_URL = "https://directory.core.trust.ib1.org/member/"
+APPLICATION_URL = "https://directory.core.trust.ib1.org/scheme/supply/application/"
+ROLE_URL = "https://registry.core.trust.ib1.org/scheme/supply/role/"
+
+FIRST_MEMBER_NUMBER = 6
+
+# (member id, organisation name, role) as in cert-gen.rb
+SCENARIO_MEMBERS = [
+    ("237256", "Industrial Metering Company", "energy-data-provider"),
+    ("293482", "Nitrogen Fertiliser Products", "supplier"),
+    ("927625", "Agricultural Wholesale Supplies", "distributor"),
+    ("143252", "Precise Farm Automation Co", "farm-management-provider"),
+    ("394722", "Rosemary Accountancy Software", "accounts-platform-provider"),
+    ("183426", "Sustainable Farm Systems", "environmental-reporting-provider"),
+    ("582373", "Green Bank of London", "financial-service-provider")
+]
+
+# Below this, starting worker processes costs more than it saves
+MIN_MEMBERS_FOR_PROCESSES = 64
+
+# ---------------------------------------------------------------------------
+
+def synthetic_members(count, first_id=100000, role="supplier"):
+    return list(map(
+        lambda n: (str(first_id + n), "Member " + str(first_id + n), role),
+        range(count)
+    ))
+
+
+def _certificate(subject, issuer, public_key, issuer_key, ca, days, extensions=()):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = (x509.CertificateBuilder().
+                subject_name(subject).
+                issuer_name(issuer).
+                public_key(public_key).
+                serial_number(x509.random_serial_number()).
+                not_valid_before(now - datetime.timedelta(days=1)).
+                not_valid_after(now + datetime.timedelta(days=days)).
+                add_extension(x509.BasicConstraints(ca=ca, path_length=0 if ca and issuer != subject else None), critical=True))
+    if ca:
+        # cRLSign, digitalSignature, keyCertSign as in scripts/extensions.cnf
+        builder = builder.add_extension(x509.KeyUsage(True, False, False, False, False, True, True, False, False), critical=True)
+    builder = builder.add_extension(x509.SubjectKeyIdentifier.from_public_key(public_key), critical=False)
+    builder = builder.add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False)
+    for extension, critical in extensions:
+        builder = builder.add_extension(extension, critical=critical)
+    return builder.sign(issuer_key, hashes.SHA256())
+
+
+def _member_certificate(member_id, name, role, issuer_name, issuer_key):
+    member_url = DIRECTORY_URL + member_id
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "GB"),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "London"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, name),
+        x509.NameAttribute(NameOID.COMMON_NAME, member_url)
+    ])
+    certificate = _certificate(subject, issuer_name, key.public_key(), issuer_key, False, 365, [
+        (x509.SubjectAlternativeName([x509.UniformResourceIdentifier(member_url)]), False),
+        (x509.UnrecognizedExtension(OID_IB1_ROLES, CertExtUTF8Sequence([ROLE_URL + role]).dump()), False),
+        (x509.UnrecognizedExtension(OID_IB1_APPLICATION, asn1.UTF8String(APPLICATION_URL + str(int(member_id) * 7)).dump()), False)
+    ])
+    return certificate, key
+
+# ---------------------------------------------------------------------------
+
+class GeneratedMember:
+
+    # A member's key and certificate, with the number and file name prefix
+    # used by certmaker.sh, eg "6-industrial-metering-company"
+
+    def __init__(self, number, member_id, name, role, certificate, key):
+        self.number = number
+        self.member_id = member_id
+        self.name = name
+        self.role = role
+        self.certificate = certificate
+        self.key = key
+
+    def file_prefix(self):
+        return str(self.number) + "-" + self.name.lower().replace(" ", "-")
+
+
+class GeneratedTrustFramework:
+
+    # data attributes:
+    #   ca_certificate, ca_key -- 4. Core Trust Framework Signing CA
+    #   issuer_certificate, issuer_key -- 5. Core Trust Framework Signing Issuer
+    #   members -- list of GeneratedMember
+
+    def __init__(self, ca_certificate, ca_key, issuer_certificate, issuer_key, members):
+        self.ca_certificate = ca_certificate
+        self.ca_key = ca_key
+        self.issuer_certificate = issuer_certificate
+        self.issuer_key = issuer_key
+        self.members = members
+
+    def signers(self, certificate_provider):
+        # file prefix -> SignerInMemory, as main.py makes from files
+        return {
+            m.file_prefix(): SignerInMemory(certificate_provider, [m.certificate, self.issuer_certificate], m.key)
+            for m in self.members
+        }
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        issuer_pem = _certificate_pem(self.issuer_certificate)
+        _write(directory, "4-signing-ca-key.pem", _key_pem(self.ca_key))
+        _write(directory, "4-signing-ca-cert.pem", _certificate_pem(self.ca_certificate))
+        _write(directory, "5-signing-issuer-key.pem", _key_pem(self.issuer_key))
+        _write(directory, "5-signing-issuer-ca.pem", issuer_pem)
+        for m in self.members:
+            certificate_pem = _certificate_pem(m.certificate)
+            _write(directory, m.file_prefix()+"-key.pem", _key_pem(m.key))
+            _write(directory, m.file_prefix()+"-cert.pem", certificate_pem)
+            _write(directory, m.file_prefix()+"-cert-bundle.pem", certificate_pem + issuer_pem)
+
+
+def _certificate_pem(certificate):
+    return certificate.public_bytes(serialization.Encoding.PEM)
+
+
+def _key_pem(key):
+    # Unencrypted PKCS8, as written by openssl genpkey
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+
+def _write(directory, filename, data):
+    with open(os.path.join(directory, filename), "wb") as f:
+        f.write(data)
+
+# ---------------------------------------------------------------------------
+
+def generate_trust_framework(members=SCENARIO_MEMBERS, processes=None):
+    # members is a list of (member id, organisation name, role). processes
+    # is the number of worker processes for member certificates, None to
+    # choose by the number of members, or 0 to generate in this process.
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    ca_name = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "GB"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Core Trust Framework"),
+        x509.NameAttribute(NameOID.COMMON_NAME, "Core Trust Framework Signing CA")
+    ])
+    ca_certificate = _certificate(ca_name, ca_name, ca_key.public_key(), ca_key, True, 3650)
+    issuer_key = ec.generate_private_key(ec.SECP256R1())
+    issuer_name = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "GB"),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "London"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Core Trust Framework"),
+        x509.NameAttribute(NameOID.COMMON_NAME, "Core Trust Framework Signing Issuer")
+    ])
+    issuer_certificate = _certificate(issuer_name, ca_name, issuer_key.public_key(), ca_key, True, 365)
+    if processes is None:
+        processes = os.cpu_count() or 1
+        if processes < 2 or len(members) < MIN_MEMBERS_FOR_PROCESSES:
+            processes = 0
+    if processes:
+        # Keys and certificates cross between processes in encoded form
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=_initialise_worker,
+                initargs=(_key_pem(issuer_key), _certificate_pem(issuer_certificate))) as executor:
+            encoded = list(executor.map(_member_in_worker, members, chunksize=max(1, len(members) // (processes * 4))))
+        generated = list(map(
+            lambda e: (x509.load_der_x509_certificate(e[0]), serialization.load_der_private_key(e[1], password=None)),
+            encoded
+        ))
+    else:
+        generated = list(map(
+            lambda m: _member_certificate(m[0], m[1], m[2], issuer_name, issuer_key),
+            members
+        ))
+    return GeneratedTrustFramework(ca_certificate, ca_key, issuer_certificate, issuer_key, [
+        GeneratedMember(FIRST_MEMBER_NUMBER + n, member_id, name, role, certificate, key)
+        for n, ((member_id, name, role), (certificate, key)) in enumerate(zip(members, generated))
+    ])
+
+# ---------------------------------------------------------------------------
+# Worker processes
+
+_worker_issuer = None
+
+def _initialise_worker(issuer_key_pem, issuer_certificate_pem):
+    global _worker_issuer
+    _worker_issuer = (
+        x509.load_pem_x509_certificate(issuer_certificate_pem).subject,
+        serialization.load_pem_private_key(issuer_key_pem, password=None)
+    )
+
+
+def _member_in_worker(member):
+    issuer_name, issuer_key = _worker_issuer
+    certificate, key = _member_certificate(member[0], member[1], member[2], issuer_name, issuer_key)
+    return (
+        certificate.public_bytes(serialization.Encoding.DER),
+        key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    )
+
+# ---------------------------------------------------------------------------
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Generate trust framework certificates for the supply chain scenarios")
+    parser.add_argument("directory", nargs="?", default="certs")
+    parser.add_argument("--members", type=int, help="generate this many synthetic members instead of the scenario's members")
+    parser.add_argument("--processes", type=int, help="worker processes, 0 to generate in this process")
+    args = parser.parse_args(argv)
+    members = SCENARIO_MEMBERS if args.members is None else synthetic_members(args.members)
+    generate_trust_framework(members, args.processes).write(args.directory)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,306 @@
+import base64
+import hashlib
+import datetime
+
+from cryptography import x509
+from cryptography.x509.verification import PolicyBuilder
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, utils
+from ib1.provenance import certificates
+
+from .cache import LRUCache
+from .instrument import span
+
+# ---------------------------------------------------------------------------
+# Certificates section of a record
+#
+# The legacy form, written by ib1.provenance, maps each serial to a list of
+# a PEM certificate followed by the serials of its issuer chain, with each
+# issuer listed under its own serial:
+#
+#   {serial: [pem, issuer serial, ...], issuer serial: [pem], ...}
+#
+# The structured form stores each distinct certificate once as base64 DER,
+# keyed by the base64url SHA-256 fingerprint of the DER, and each signer's
+# chain as a list of fingerprints, signing certificate first:
+#
+#   {"der": {fingerprint: der, ...}, "chains": {serial: [fingerprint, ...], ...}}
+
+def is_structured_certificates(certificates):
+    return "chains" in certificates and "der" in certificates
+
+
+def certificate_fingerprint(der):
+    return base64.urlsafe_b64encode(hashlib.sha256(der).digest()).decode("utf-8").rstrip("=")
+
+
+def _der_from_pem(pem):
+    lines = pem.strip().splitlines()
+    if len(lines) < 3 or lines[0] != "-----BEGIN CERTIFICATE-----" or lines[-1] != "-----END CERTIFICATE-----":
+        raise Exception("Not a PEM encoded certificate in record")
+    return base64.b64decode("".join(lines[1:-1]))
+
+
+def _add_der(structured, der):
+    fingerprint = certificate_fingerprint(der)
+    structured["der"].setdefault(fingerprint, base64.b64encode(der).decode("utf-8"))
+    return fingerprint
+
+
+def empty_certificates():
+    return {"der": {}, "chains": {}}
+
+
+def merge_certificates(structured, certificates_from_record):
+    # Add certificates from a record, in either form, to a structured section
+    if not certificates_from_record:
+        return structured
+    if is_structured_certificates(certificates_from_record):
+        # The section isn't signed, so fingerprints are checked rather than
+        # trusted, and a certificate already present is never replaced
+        for fingerprint, encoded_der in certificates_from_record["der"].items():
+            if structured["der"].get(fingerprint) == encoded_der:
+                continue
+            if certificate_fingerprint(base64.b64decode(encoded_der, validate=True)) != fingerprint:
+                raise Exception("Certificate in record does not match its fingerprint: "+fingerprint)
+            structured["der"].setdefault(fingerprint, encoded_der)
+        for serial, chain in certificates_from_record["chains"].items():
+            structured["chains"].setdefault(serial, list(chain))
+        return structured
+    fingerprints = {}
+    def fingerprint_for_serial(serial):
+        if serial not in fingerprints:
+            fingerprints[serial] = _add_der(structured, _der_from_pem(certificates_from_record[serial][0]))
+        return fingerprints[serial]
+    issuer_serials = set()
+    for path in certificates_from_record.values():
+        issuer_serials.update(path[1:])
+    for serial, path in certificates_from_record.items():
+        # Issuers are only listed to be referenced by signers' paths
+        if serial in issuer_serials and len(path) == 1:
+            continue
+        if serial not in structured["chains"]:
+            structured["chains"][serial] = list(map(fingerprint_for_serial, [serial] + path[1:]))
+    return structured
+
+
+def add_certificate_chain(structured, serial, certificates):
+    # certificates is a list of x509 certificates, signing certificate first
+    structured["chains"][serial] = list(map(
+        lambda c: _add_der(structured, c.public_bytes(serialization.Encoding.DER)),
+        certificates
+    ))
+
+
+def structured_certificates(certificates_from_record):
+    return merge_certificates(empty_certificates(), certificates_from_record)
+
+
+def legacy_certificates(certificates_from_record):
+    # Certificates section readable by ib1.provenance
+    if not is_structured_certificates(certificates_from_record):
+        return certificates_from_record
+    der = certificates_from_record["der"]
+    certificates = {}
+    serial_for_fingerprint = {}
+    for serial, chain in certificates_from_record["chains"].items():
+        serial_for_fingerprint[chain[0]] = serial
+    def legacy_serial(fingerprint):
+        serial = serial_for_fingerprint.get(fingerprint)
+        certificate = None
+        if serial is None:
+            certificate = x509.load_der_x509_certificate(base64.b64decode(der[fingerprint]))
+            serial = str(certificate.serial_number)
+            serial_for_fingerprint[fingerprint] = serial
+        if serial not in certificates:
+            if certificate is None:
+                certificate = x509.load_der_x509_certificate(base64.b64decode(der[fingerprint]))
+            certificates[serial] = [certificate.public_bytes(serialization.Encoding.PEM).decode("utf-8")]
+        return serial
+    for serial, chain in certificates_from_record["chains"].items():
+        legacy_serial(chain[0])
+        certificates[serial].extend(map(legacy_serial, chain[1:]))
+    return certificates
+
+
+def certificates_subset(certificates_from_record, serial):
+    # Only the certificates needed to check a signature by serial
+    if is_structured_certificates(certificates_from_record):
+        chain = certificates_from_record["chains"].get(serial)
+        if chain is None:
+            return empty_certificates()
+        return {
+            "der": {f: certificates_from_record["der"][f] for f in chain if f in certificates_from_record["der"]},
+            "chains": {serial: chain}
+        }
+    certs = certificates_from_record.get(serial)
+    if certs is None:
+        return {}
+    subset = {serial: certs}
+    for s in certs[1:]:
+        if s in certificates_from_record:
+            subset[s] = certificates_from_record[s]
+    return subset
+
+# ---------------------------------------------------------------------------
+
+class CertificateCache:
+
+    # Parsed certificates and validated chains, shared by every provider in
+    # the process. Certificates are keyed by the SHA-256 fingerprint of their
+    # encoded form. A validated chain is keyed by the root store and the
+    # fingerprints of the chain, and remembers the period in which every
+    # certificate in it is valid, so it only answers for signing times in
+    # which the full chain validation would have succeeded.
+
+    def __init__(self, max_certificates=4096, max_chains=4096):
+        self._certificates = LRUCache(max_certificates)
+        self._chains = LRUCache(max_chains)
+
+    def certificate_from_pem(self, pem):
+        fingerprint = hashlib.sha256(pem.encode("utf-8")).digest()
+        certificate = self._certificates.get(fingerprint)
+        if certificate is None:
+            certificate = x509.load_pem_x509_certificate(pem.encode("utf-8"))
+            self._certificates.put(fingerprint, certificate)
+        return certificate
+
+    def certificate_from_der(self, encoded_der):
+        # Keyed by the encoded text rather than a fingerprint claimed by the record
+        fingerprint = hashlib.sha256(encoded_der.encode("utf-8")).digest()
+        certificate = self._certificates.get(fingerprint)
+        if certificate is None:
+            certificate = x509.load_der_x509_certificate(base64.b64decode(encoded_der))
+            self._certificates.put(fingerprint, certificate)
+        return certificate
+
+    def validated_chain(self, key, verification_time):
+        entry = self._chains.get(key)
+        if entry is None:
+            return None
+        valid_from, valid_until, signer_info = entry
+        if not (valid_from <= verification_time <= valid_until):
+            return None
+        return signer_info
+
+    def add_validated_chain(self, key, chain, signer_info):
+        valid_from = max(map(lambda c: c.not_valid_before_utc, chain))
+        valid_until = min(map(lambda c: c.not_valid_after_utc, chain))
+        self._chains.put(key, (valid_from, valid_until, signer_info))
+
+    def stats(self):
+        return {
+            "certificates": {"hits": self._certificates.hits, "misses": self._certificates.misses, "size": len(self._certificates)},
+            "chains": {"hits": self._chains.hits, "misses": self._chains.misses, "size": len(self._chains)}
+        }
+
+    def clear(self):
+        self._certificates.clear()
+        self._chains.clear()
+
+
+DEFAULT_CERTIFICATE_CACHE = CertificateCache()
+
+
+def certificates_for_serial(certificates_from_record, serial, certificate_cache=None):
+    # The chain for a serial from a certificates section in either form,
+    # signing certificate first. The chain is not validated.
+    if certificate_cache is None:
+        certificate_cache = DEFAULT_CERTIFICATE_CACHE
+    if is_structured_certificates(certificates_from_record):
+        chain = certificates_from_record["chains"].get(serial)
+        if chain is None:
+            raise Exception("Certificate serial "+serial+" is not present in record")
+        der = certificates_from_record["der"]
+        return list(map(lambda f: certificate_cache.certificate_from_der(der[f]), chain))
+    certs = certificates_from_record.get(serial)
+    if certs is None:
+        raise Exception("Certificate serial "+serial+" is not present in record")
+    signing_cert, *path_serials = certs
+    cert_chain = [signing_cert]
+    cert_chain.extend(list(map(
+        lambda s: certificates_from_record[s][0],
+        path_serials
+    )))
+    return list(map(certificate_cache.certificate_from_pem, cert_chain))
+
+
+def chain_digest(certificates_from_record, serial, certificate_cache=None):
+    # SHA-256 over the fingerprints of the chain for a serial, signing
+    # certificate first. The certificates section isn't signed, so a layer
+    # is only taken as verified again if checked with the same chain.
+    h = hashlib.sha256()
+    for certificate in certificates_for_serial(certificates_from_record, serial, certificate_cache):
+        h.update(certificate.fingerprint(hashes.SHA256()))
+    return h.digest()
+
+# ---------------------------------------------------------------------------
+
+class CertificatesProviderSelfContainedRecord(certificates.CertificatesProviderSelfContainedRecord):
+
+    # Drop in replacement for the ib1.provenance provider which parses each
+    # distinct certificate once and validates each distinct chain once, using
+    # a CertificateCache (the process wide cache by default). Reads both the
+    # legacy and structured forms of the certificates section.
+
+    def __init__(self, root_ca_certificate, certificate_cache=None):
+        super().__init__(root_ca_certificate)
+        with open(root_ca_certificate, "rb") as f:
+            root_pem = f.read()
+        self._root_certificates = x509.load_pem_x509_certificates(root_pem)
+        self._root_fingerprint = hashlib.sha256(root_pem).digest()
+        self._certificate_cache = certificate_cache if certificate_cache is not None else DEFAULT_CERTIFICATE_CACHE
+
+    def certificate_cache(self):
+        return self._certificate_cache
+
+    def identity(self):
+        # SHA-256 of the root CA certificates file, see cache.provider_identity()
+        return self._root_fingerprint
+
+    def certificates_for_serial(self, certificates_from_record, serial):
+        return certificates_for_serial(certificates_from_record, serial, self._certificate_cache)
+
+    def _verify(self, certificates_from_record, serial, sign_timestamp, data, signature):
+        signing_cert, signer_info = self._validated_signer(certificates_from_record, serial, sign_timestamp)
+        # 2) check signature on data
+        pubkey = signing_cert.public_key()
+        with span("verify.ecdsa", bytes=len(data)):
+            pubkey.verify(signature, data, ec.ECDSA(hashes.SHA256()))
+        # Return information about the signer (a copy, as records attach it to steps)
+        return dict(signer_info)
+
+    def _verify_prehashed(self, certificates_from_record, serial, sign_timestamp, digest, signature):
+        # As _verify(), given the SHA-256 digest of the data instead of the data
+        signing_cert, signer_info = self._validated_signer(certificates_from_record, serial, sign_timestamp)
+        pubkey = signing_cert.public_key()
+        with span("verify.ecdsa"):
+            pubkey.verify(signature, digest, ec.ECDSA(utils.Prehashed(hashes.SHA256())))
+        return dict(signer_info)
+
+    def _validated_signer(self, certificates_from_record, serial, sign_timestamp):
+        certs = self.certificates_for_serial(certificates_from_record, serial)
+        # first certificate in file is signing certificate
+        signing_cert, *issuer_chain = certs
+        # 1) check certificate chain validity at the time of signature, unless
+        #    this chain is already known to be valid at that time
+        verification_time = datetime.datetime.fromisoformat(sign_timestamp)
+        chain_key = (self._root_fingerprint,) + tuple(map(lambda c: c.fingerprint(hashes.SHA256()), certs))
+        with span("verify.chain", serial=serial) as s:
+            signer_info = self._certificate_cache.validated_chain(chain_key, verification_time)
+            s.set("certificate_cache", "miss" if signer_info is None else "hit")
+            if signer_info is None:
+                verifier = (PolicyBuilder().
+                                store(self._ca_store).
+                                time(verification_time).
+                                build_client_verifier())
+                verifier.verify(signing_cert, issuer_chain)
+                cert_info = certificates.SigningCertificate(signing_cert)
+                signer_info = {
+                    "member": cert_info.subject(),
+                    "name": cert_info.organisation_name(),
+                    "application": cert_info.application(),
+                    "roles": cert_info.roles()
+                }
+                self._certificate_cache.add_validated_chain(chain_key, certs + self._root_certificates, signer_info)
+        return (signing_cert, signer_info)
@@ -0,0 +1,155 @@
+# Compact in-memory representation of verified steps, for records with
+# very many steps.
+#
+# A decoded step is a dict with its own copies of every key and value, and
+# a _signature dict and includedBy list of its own. Here each step is a
+# CompactStep holding a tuple of its values, with the keys shared by every
+# step with the same keys, and a reference to a LayerSignature made once
+# for all the steps signed by the same signer and included by the same
+# signers. Strings are interned as the steps are built, so URIs, names and
+# step ids referred to by other steps are held once however many steps
+# use them.
+#
+# CompactStep is a read only Mapping, so it can be used where decoded steps
+# are only read. Use to_dict() for a plain dict, eg for json.dumps().
+
+import copy
+import json
+import collections.abc
+
+
+class StepShape:
+
+    # The keys of a step, in order, shared by every step with those keys
+
+    __slots__ = ("keys", "index")
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = {k: i for i, k in enumerate(keys)}
+
+
+class LayerSignature:
+
+    # Signer information for the steps in a layer, as the _signature
+    # property of a decoded step. Signer info dicts are shared too.
+
+    __slots__ = ("signed", "included_by", "_signature")
+
+    def __init__(self, signed, included_by):
+        self.signed = signed
+        self.included_by = included_by
+        self._signature = None
+
+    def signature(self):
+        if self._signature is None:
+            self._signature = {
+                "signed": self.signed,
+                "includedBy": list(self.included_by)
+            }
+        return self._signature
+
+
+class CompactStep(collections.abc.Mapping):
+
+    __slots__ = ("_shape", "_values", "_layer")
+
+    def __init__(self, shape, values, layer):
+        self._shape = shape
+        self._values = values
+        self._layer = layer
+
+    def __getitem__(self, key):
+        i = self._shape.index.get(key)
+        if i is not None:
+            return self._values[i]
+        if key == "_signature":
+            return self._layer.signature()
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._shape.index or key == "_signature"
+
+    def __iter__(self):
+        yield from self._shape.keys
+        yield "_signature"
+
+    def __len__(self):
+        return len(self._shape.keys) + 1
+
+    def __repr__(self):
+        return "CompactStep(" + repr(self.to_dict()) + ")"
+
+    def signer(self):
+        return self._layer.signed
+
+    def included_by(self):
+        return self._layer.included_by
+
+    def to_dict(self, memo=None):
+        # As a step in Record.decoded(), sharing nothing with this step. Steps
+        # converted with the same copy.deepcopy() memo dict share their
+        # _signature values, as those from Record.decoded() do.
+        if memo is None:
+            memo = {}
+        step = dict(zip(self._shape.keys, copy.deepcopy(self._values, memo)))
+        step["_signature"] = copy.deepcopy(self._layer.signature(), memo)
+        return step
+
+
+class CompactStepBuilder:
+
+    # Makes CompactSteps from decoded steps, sharing shapes, signer
+    # information and strings between them. Only needed while the steps
+    # are made: the steps keep what they use.
+    #
+    # data attributes:
+    #   _strings -- string -> the instance of it used by steps
+    #   _shapes -- tuple of keys -> StepShape
+    #   _signers -- canonical JSON of a signer info dict -> shared dict
+    #   _layers -- tuple of id() of signer info dicts, signer first -> LayerSignature
+
+    def __init__(self):
+        self._strings = {}
+        self._shapes = {}
+        self._signers = {}
+        self._layers = {}
+
+    def layer(self, signed, signer_stack):
+        # The LayerSignature for steps signed with signed, included by the
+        # signers in signer_stack, outermost first
+        signers = list(map(self._signer, [signed] + signer_stack))
+        key = tuple(map(id, signers))
+        layer = self._layers.get(key)
+        if layer is None:
+            layer = LayerSignature(signers[0], tuple(signers[1:]))
+            self._layers[key] = layer
+        return layer
+
+    def step(self, decoded_step, layer):
+        keys = tuple(map(self._intern, decoded_step.keys()))
+        shape = self._shapes.get(keys)
+        if shape is None:
+            shape = StepShape(keys)
+            self._shapes[keys] = shape
+        return CompactStep(shape, tuple(map(self._value, decoded_step.values())), layer)
+
+    def _signer(self, signer_info):
+        key = json.dumps(signer_info, sort_keys=True)
+        shared = self._signers.get(key)
+        if shared is None:
+            shared = self._value(signer_info)
+            self._signers[key] = shared
+        return shared
+
+    def _intern(self, s):
+        return self._strings.setdefault(s, s)
+
+    def _value(self, value):
+        if isinstance(value, str):
+            return self._strings.setdefault(value, value)
+        if isinstance(value, list):
+            return list(map(self._value, value))
+        if isinstance(value, dict):
+            return {self._intern(k): self._value(v) for k, v in value.items()}
+        return value
@@ -0,0 +1,107 @@
+import json
+
+from .lineage import STEP_REFERENCE_KEYS
+
+
+# Node shapes used by ib1.provenance Record.to_graphviz()
+NODE_SHAPES = {
+    "permission": "invhouse",
+    "origin": "diamond",
+    "receipt": "box3d",
+    "process": "parallelogram"
+}
+
+# ---------------------------------------------------------------------------
+# Exporters which write as they go to a text file-like object, so exporting
+# a large record takes time linear in its steps and memory which does not
+# grow with them.
+#
+# steps is any iterable of decoded steps with _signature information, such
+# as Record.decoded(), or a verified RecordView, which also allows steps to
+# be grouped by the signed layer they are in.
+
+def _layered_steps(steps, clusters):
+    # Yields (step, cluster key, cluster label)
+    if hasattr(steps, "layers") and hasattr(steps, "step"):
+        for layer in steps.layers():
+            for step_id in layer.step_ids:
+                step = steps.step(step_id)
+                yield (step, *_cluster_for(step, clusters, layer))
+    else:
+        for step in steps:
+            yield (step, *_cluster_for(step, clusters, None))
+
+
+def _cluster_for(step, clusters, layer):
+    signed = step.get("_signature", {}).get("signed")
+    name = signed["name"] if signed is not None else None
+    match clusters:
+        case None:
+            return (None, None)
+        case "member":
+            return (name, name)
+        case "layer":
+            if layer is not None:
+                return (layer.index, (name or "") + " (" + layer.serial + ")")
+            # Without a view, steps signed by the same chain of signers
+            included_by = step.get("_signature", {}).get("includedBy", [])
+            return (tuple(map(lambda s: s["member"], included_by)) + ((signed or {}).get("member"),), name)
+        case _:
+            raise Exception("Unknown clusters for graph export: "+str(clusters))
+
+
+def _edges(step):
+    for key in STEP_REFERENCE_KEYS:
+        value = step.get(key)
+        if value is None:
+            continue
+        for referenced in (value if isinstance(value, list) else [value]):
+            yield (referenced, key)
+
+
+def _quote(text):
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def write_graphviz(steps, out, clusters="member"):
+    # clusters is "member" for a subgraph per signing member, "layer" for a
+    # subgraph per signed layer, or None. A subgraph is written again for
+    # each step in it, which Graphviz merges, so only the cluster names are
+    # remembered rather than every step.
+    cluster_names = {}
+    out.write("digraph ProvenanceRecord {\n")
+    for step, cluster_key, cluster_label in _layered_steps(steps, clusters):
+        step_id = step["id"]
+        for referenced, key in _edges(step):
+            out.write("  "+_quote(referenced)+" -> "+_quote(step_id)+" [label="+key+"];\n")
+        shape = NODE_SHAPES.get(step["type"], "box")
+        out.write("  "+_quote(step_id)+" [shape="+shape+",label="+_quote(step["type"]+"\n"+step_id).replace("\n", "\\n")+"];\n")
+        if cluster_key is not None:
+            name = cluster_names.get(cluster_key)
+            if name is None:
+                name = "cluster_"+str(len(cluster_names))
+                cluster_names[cluster_key] = name
+                out.write("  subgraph "+name+" {\n    graph[style=dashed];\n    label = "+_quote(cluster_label or "")+";\n    "+_quote(step_id)+";\n  }\n")
+            else:
+                out.write("  subgraph "+name+" { "+_quote(step_id)+"; }\n")
+    out.write("}\n")
+
+
+def write_graph_jsonl(steps, out, clusters="member"):
+    # One JSON object per line, for graph tools: a node for each step, then
+    # an edge for each step it refers to
+    #   {"node": id, "type": type, "timestamp": timestamp, "member": member url, "cluster": label}
+    #   {"edge": [from id, to id], "label": key}
+    for step, cluster_key, cluster_label in _layered_steps(steps, clusters):
+        signed = step.get("_signature", {}).get("signed")
+        node = {
+            "node": step["id"],
+            "type": step["type"],
+            "timestamp": step.get("timestamp"),
+            "member": signed["member"] if signed is not None else None
+        }
+        if cluster_key is not None:
+            node["cluster"] = cluster_label
+        out.write(json.dumps(node, separators=(",", ":"))+"\n")
+        for referenced, key in _edges(step):
+            out.write(json.dumps({"edge": [referenced, step["id"]], "label": key}, separators=(",", ":"))+"\n")
@@ -0,0 +1,200 @@
+# Lightweight instrumentation of the provenance lifecycle.
+#
+# Record operations are measured as spans, nested within each other, with
+# attributes such as byte sizes, step counts and cache hits. Each finished
+# span is passed to every hook added with add_hook(). A hook is any
+# callable taking a Span. With no hooks, span() returns a shared object
+# which does nothing, so uninstrumented code pays for a function call and
+# a list check.
+#
+#   summary = ProfileSummary()
+#   add_hook(summary)
+#   add_hook(JsonLinesExporter(open("spans.jsonl", "w")))
+#   set_participant("manufacturer")
+#   ... use Records ...
+#   summary.report(sys.stdout)
+
+import json
+import time
+import itertools
+import threading
+import contextvars
+
+
+_hooks = []
+_span_ids = itertools.count(1)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_participant = contextvars.ContextVar("participant", default=None)
+
+# ---------------------------------------------------------------------------
+
+def add_hook(hook):
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def set_participant(name):
+    # Spans started after this, in this thread or context, are attributed
+    # to the named participant in the scenario
+    _participant.set(name)
+
+
+def span(name, **attributes):
+    if not _hooks:
+        return _NO_SPAN
+    return Span(name, attributes)
+
+# ---------------------------------------------------------------------------
+
+class Span:
+
+    __slots__ = ("span_id", "name", "attributes", "parent_id", "participant", "start", "seconds", "_token")
+
+    def __init__(self, name, attributes):
+        self.span_id = next(_span_ids)
+        self.name = name
+        self.attributes = attributes
+        self.parent_id = None
+        self.participant = _participant.get()
+        self.start = None
+        self.seconds = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is not None:
+            self.parent_id = parent.span_id
+        self._token = _current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self.start
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        for hook in list(_hooks):
+            hook(self)
+        return False
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            "span": self.name,
+            "id": self.span_id,
+            "parent": self.parent_id,
+            "participant": self.participant,
+            "start": self.start,
+            "seconds": self.seconds,
+            **self.attributes
+        }
+
+
+class _NoSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, key, value):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+# ---------------------------------------------------------------------------
+# Hooks
+
+class JsonLinesExporter:
+
+    # Writes each finished span as a line of JSON to a text file-like object
+
+    def __init__(self, out):
+        self._out = out
+        self._lock = threading.Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span.to_dict(), separators=(",", ":"), default=str) + "\n"
+        with self._lock:
+            self._out.write(line)
+
+
+class ProfileSummary:
+
+    # Totals for each participant and span name: count, time, bytes, and
+    # hits in the verified layer cache ("cache" attribute) and the
+    # certificate chain cache ("certificate_cache" attribute)
+    #
+    # data attributes:
+    #   _totals -- (participant, span name) -> [count, seconds, bytes, layer cache hits,
+    #              layer cache misses, certificate cache hits, certificate cache misses]
+
+    def __init__(self):
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, span):
+        key = (span.participant, span.name)
+        with self._lock:
+            totals = self._totals.get(key)
+            if totals is None:
+                totals = [0, 0.0, 0, 0, 0, 0, 0]
+                self._totals[key] = totals
+            totals[0] += 1
+            totals[1] += span.seconds
+            totals[2] += span.attributes.get("bytes", 0)
+            match span.attributes.get("cache"):
+                case "hit":
+                    totals[3] += 1
+                case "miss":
+                    totals[4] += 1
+            match span.attributes.get("certificate_cache"):
+                case "hit":
+                    totals[5] += 1
+                case "miss":
+                    totals[6] += 1
+
+    def totals(self):
+        with self._lock:
+            return [
+                {
+                    "participant": participant,
+                    "span": name,
+                    "count": count,
+                    "seconds": seconds,
+                    "bytes": size,
+                    "cacheHits": hits,
+                    "cacheMisses": misses,
+                    "certificateCacheHits": certificate_hits,
+                    "certificateCacheMisses": certificate_misses
+                }
+                for (participant, name), (count, seconds, size, hits, misses, certificate_hits, certificate_misses) in self._totals.items()
+            ]
+
+    def report(self, out):
+        participants = []
+        for t in self.totals():
+            if t["participant"] not in participants:
+                participants.append(t["participant"])
+        for participant in participants:
+            rows = [t for t in self.totals() if t["participant"] == participant]
+            out.write("----- " + (participant if participant is not None else "(no participant)") + " -----\n")
+            out.write("  span                       count     total ms       bytes  layer cache  cert cache\n")
+            for t in sorted(rows, key=lambda t: t["span"]):
+                out.write("  %-24s %7d %12.3f %11d  %11s  %10s\n" % (
+                    t["span"], t["count"], t["seconds"] * 1000, t["bytes"],
+                    _hit_rate(t["cacheHits"], t["cacheMisses"]),
+                    _hit_rate(t["certificateCacheHits"], t["certificateCacheMisses"])
+                ))
+
+
+def _hit_rate(hits, misses):
+    if not hits + misses:
+        return "-"
+    return "%.0f%%" % (100.0 * hits / (hits + misses))
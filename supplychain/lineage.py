@@ -0,0 +1,111 @@
+import collections
+
+
+# Keys of a step which refer to other steps, and the label of the edge.
+# Edges point from the referenced step to the referencing step, as in
+# Record.to_graphviz().
+STEP_REFERENCE_KEYS = ("of", "transfer", "inputs", "permissions")
+
+# ---------------------------------------------------------------------------
+
+class LineageIndex:
+
+    # Adjacency index over the steps of a record, built once and then used
+    # for any number of queries. Each traversal visits only the steps and
+    # edges in its answer.
+    #
+    # steps is any iterable of decoded steps, such as Record.decoded(), or a
+    # RecordView, in which case the index is built from the view's steps.
+    #
+    # data attributes:
+    #   _types -- step id -> step type
+    #   _parents -- step id -> list of (referenced step id, label)
+    #   _children -- step id -> list of (referencing step id, label)
+
+    def __init__(self, steps, origins=None):
+        if hasattr(steps, "ids") and hasattr(steps, "step"):
+            if origins is None:
+                origins = list(map(lambda s: s["id"], steps.origins()))
+            steps = map(steps.step, steps.ids())
+        self._types = {}
+        self._parents = collections.defaultdict(list)
+        self._children = collections.defaultdict(list)
+        for step in steps:
+            step_id = step["id"]
+            self._types[step_id] = step["type"]
+            for key in STEP_REFERENCE_KEYS:
+                value = step.get(key)
+                if value is None:
+                    continue
+                for referenced in (value if isinstance(value, list) else [value]):
+                    self._parents[step_id].append((referenced, key))
+                    self._children[referenced].append((step_id, key))
+        # The origins list in the encoded record seeds origin tracing
+        if origins is None:
+            origins = [i for i, t in self._types.items() if t == "origin"]
+        self._origins = set(origins)
+
+    def __contains__(self, step_id):
+        return step_id in self._types
+
+    def type_of(self, step_id):
+        return self._types[step_id]
+
+    def parents(self, step_id, labels=None):
+        return [i for i, label in self._parents.get(step_id, []) if labels is None or label in labels]
+
+    def children(self, step_id, labels=None):
+        return [i for i, label in self._children.get(step_id, []) if labels is None or label in labels]
+
+    def ancestors(self, step_id, labels=None):
+        # Every step the given step derives from, nearest first
+        return self._traverse(step_id, self._parents, labels)
+
+    def descendants(self, step_id, labels=None):
+        # Every step derived from the given step, nearest first
+        return self._traverse(step_id, self._children, labels)
+
+    def _traverse(self, step_id, edges, labels):
+        self._require_step(step_id)
+        seen = {step_id}
+        found = []
+        queue = collections.deque([step_id])
+        while queue:
+            current = queue.popleft()
+            for next_id, label in edges.get(current, []):
+                if (labels is None or label in labels) and next_id not in seen:
+                    seen.add(next_id)
+                    found.append(next_id)
+                    queue.append(next_id)
+        return found
+
+    def origins_of(self, step_id):
+        # Origin steps which feed into the given step, through the data flow
+        # (permissions are not followed)
+        return [i for i in self.ancestors(step_id, ("of", "transfer", "inputs")) if i in self._origins]
+
+    def permissions_for(self, step_id):
+        # Permission steps directly authorising the given step
+        return [i for i in self.parents(step_id, ("permissions",)) if self._types.get(i) == "permission"]
+
+    def permission_coverage(self, step_id):
+        # The permissions authorising each step in the data flow leading to
+        # the given step, including itself: step id -> list of permission ids.
+        # Steps which need a permission but have none are listed with [].
+        coverage = {}
+        for i in [step_id] + self.ancestors(step_id, ("of", "transfer", "inputs")):
+            if self._types.get(i) in ("transfer", "process", "origin"):
+                coverage[i] = self.permissions_for(i)
+        return coverage
+
+    def uncovered_steps(self, step_id):
+        # Transfers and processes leading to the given step without a permission
+        coverage = self.permission_coverage(step_id)
+        return [i for i, permissions in coverage.items() if not permissions and self._types[i] != "origin"]
+
+    def steps_using_permission(self, permission_id):
+        return self.children(permission_id, ("permissions",))
+
+    def _require_step(self, step_id):
+        if step_id not in self._types:
+            raise Exception("No step with id "+step_id+" in record")
@@ -0,0 +1,252 @@
+# Merkle commitments and inclusion proofs for the steps of a record.
+#
+# When signed with merkle_commitment=True, a layer also commits to a
+# Merkle tree over its contents. Each step is a leaf, and so is each
+# nested layer, through its own root and its signature block. The signer
+# signs the root separately from the layer, and the root and this second
+# signature are written under "merkle" at the top level of the record,
+# keyed by the layer's signature:
+#
+#   {"merkle": {layer signature: [root, commitment signature], ...}, ...}
+#
+# The layers and their signatures are unchanged, so the record can still be
+# read by ib1.provenance. The merkle section itself is not covered by any
+# layer's signature, so Record.verify() and Record.sign() keep only the
+# entries returned by checked_commitments(): those whose root matches the
+# layer's contents and whose signature is by the layer's signer. Entries
+# are then carried through when a record is included in another.
+#
+# A proof for one step holds the step, the sibling hashes on the path to
+# the root of each layer enclosing it, each layer's signature block and
+# commitment signature, and the certificates for those signers. Checking it
+# costs O(log n) hashes and one signature check per enclosing layer.
+#
+#   {
+#     "ib1:provenance": trust framework,
+#     "step": encoded step,
+#     "layers": [{"index": i, "count": n, "siblings": [hash, ...],
+#                 "signature": signature block, "commitment": signature}, ...],
+#     "certificates": {...}
+#   }
+#
+# Layers are listed innermost first. Hashes and signatures are base64url.
+
+import json
+import base64
+import hashlib
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from .view import RecordView
+from .certificates import empty_certificates, merge_certificates, certificates_subset, certificates_for_serial
+
+
+# Domain separation, so a leaf can't be presented as an interior node
+STEP_LEAF_PREFIX = b"\x00"
+INTERIOR_NODE_PREFIX = b"\x01"
+LAYER_LEAF_PREFIX = b"\x02"
+
+# ---------------------------------------------------------------------------
+
+def _encode_hash(digest):
+    return base64.urlsafe_b64encode(digest).decode("utf-8")
+
+
+def _decode_hash(encoded):
+    digest = base64.urlsafe_b64decode(encoded)
+    if len(digest) != hashlib.sha256().digest_size:
+        raise Exception("Bad hash in Merkle proof")
+    return digest
+
+
+def _interior_node(left, right):
+    return hashlib.sha256(INTERIOR_NODE_PREFIX + left + right).digest()
+
+
+def step_leaf(encoded_step):
+    return hashlib.sha256(STEP_LEAF_PREFIX + encoded_step.encode("utf-8")).digest()
+
+
+def layer_leaf(root, sig_block):
+    container_format_version, serial, sign_timestamp, signature = sig_block
+    signed = ".".join([str(container_format_version), serial, sign_timestamp, signature])
+    return hashlib.sha256(LAYER_LEAF_PREFIX + root + signed.encode("utf-8")).digest()
+
+
+def merkle_root(leaves):
+    # An odd node at the end of a level is carried up to the next level
+    if not leaves:
+        return hashlib.sha256(b"").digest()
+    level = leaves
+    while len(level) > 1:
+        level = [
+            _interior_node(level[i], level[i+1]) if i+1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+    return level[0]
+
+
+def merkle_path(leaves, index):
+    siblings = []
+    level = leaves
+    while len(level) > 1:
+        if index ^ 1 < len(level):
+            siblings.append(level[index ^ 1])
+        level = [
+            _interior_node(level[i], level[i+1]) if i+1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+        index //= 2
+    return siblings
+
+
+def root_from_path(leaf, index, count, siblings):
+    if not (0 <= index < count):
+        raise Exception("Bad leaf index in Merkle proof")
+    node = leaf
+    used = 0
+    while count > 1:
+        if index ^ 1 < count:
+            if used == len(siblings):
+                raise Exception("Merkle proof path is too short")
+            sibling = siblings[used]
+            used += 1
+            node = _interior_node(sibling, node) if index & 1 else _interior_node(node, sibling)
+        index //= 2
+        count = (count + 1) // 2
+    if used != len(siblings):
+        raise Exception("Merkle proof path is too long")
+    return node
+
+# ---------------------------------------------------------------------------
+
+def layer_leaves(data, commitments):
+    # data is the contents of a layer without its signature block. Nested
+    # layers use their committed root if the record has one.
+    return list(map(
+        lambda e: step_leaf(e) if isinstance(e, str) else layer_leaf(layer_root(e, commitments), e[-1]),
+        data
+    ))
+
+
+def layer_root(container, commitments):
+    entry = commitments.get(container[-1][3])
+    if entry is not None:
+        return _decode_hash(entry[0])
+    return merkle_root(layer_leaves(container[:-1], commitments))
+
+
+def commitment_data_for_signing(trust_framework, root, container_format_version, serial, sign_timestamp):
+    return ".".join([trust_framework, "merkle", _encode_hash(root), str(container_format_version), serial, sign_timestamp]).encode("utf-8")
+
+
+def commitment_entry(root, commitment_signature):
+    return [_encode_hash(root), base64.urlsafe_b64encode(commitment_signature).decode("utf-8")]
+
+
+def checked_commitments(trust_framework, encoded_record, certificate_cache=None):
+    # The entries of the record's merkle section whose root is the root of
+    # the layer's contents, and whose signature verifies with the key of
+    # the layer's signing certificate. Other entries are left out. The
+    # certificate chain is checked when the layer's own signature is.
+    commitments = encoded_record.get("merkle")
+    checked = {}
+    if commitments:
+        certificates_from_record = encoded_record.get("certificates") or {}
+        _check_commitments(trust_framework, encoded_record["steps"], commitments, certificates_from_record, certificate_cache, checked)
+    return checked
+
+
+def _check_commitments(trust_framework, container, commitments, certificates_from_record, certificate_cache, checked):
+    *data, sig_block = container
+    # Innermost first, so enclosing layers use only checked roots
+    for e in data:
+        if not isinstance(e, str):
+            _check_commitments(trust_framework, e, commitments, certificates_from_record, certificate_cache, checked)
+    container_format_version, serial, sign_timestamp, signature = sig_block
+    entry = commitments.get(signature)
+    if entry is None:
+        return
+    try:
+        root = merkle_root(layer_leaves(data, checked))
+        if _decode_hash(entry[0]) != root:
+            return
+        signing_cert = certificates_for_serial(certificates_from_record, serial, certificate_cache)[0]
+        signing_cert.public_key().verify(
+            base64.urlsafe_b64decode(entry[1]),
+            commitment_data_for_signing(trust_framework, root, container_format_version, serial, sign_timestamp),
+            ec.ECDSA(hashes.SHA256())
+        )
+    except Exception:
+        return
+    checked[signature] = entry
+
+# ---------------------------------------------------------------------------
+
+def merkle_proof(encoded_record, step_id):
+    # Proof that a step is included in a record, from the encoded form as
+    # returned by Record.encoded(). Every layer enclosing the step must
+    # have a Merkle commitment.
+    commitments = encoded_record.get("merkle", {})
+    path, offset = RecordView(encoded_record).position_of(step_id)
+    containers = [encoded_record["steps"]]
+    for index in path:
+        containers.append(containers[-1][index])
+    indexes = path + [offset]
+    certificates_from_record = encoded_record.get("certificates") or {}
+    certificates = empty_certificates()
+    layers = []
+    for container, index in reversed(list(zip(containers, indexes))):
+        sig_block = container[-1]
+        entry = commitments.get(sig_block[3])
+        if entry is None:
+            raise Exception("Layer signed by "+sig_block[1]+" has no Merkle commitment")
+        leaves = layer_leaves(container[:-1], commitments)
+        layers.append({
+            "index": index,
+            "count": len(leaves),
+            "siblings": list(map(_encode_hash, merkle_path(leaves, index))),
+            "signature": sig_block,
+            "commitment": entry[1]
+        })
+        merge_certificates(certificates, certificates_subset(certificates_from_record, sig_block[1]))
+    proof = {
+        "ib1:provenance": encoded_record["ib1:provenance"],
+        "step": containers[-1][offset],
+        "layers": layers
+    }
+    if certificates["chains"]:
+        proof["certificates"] = certificates
+    return proof
+
+
+def verify_merkle_proof(proof, trust_framework, certificate_provider):
+    # Returns the decoded step with _signature information as in
+    # Record.decoded(), or raises an Exception if the proof is not valid.
+    if proof.get("ib1:provenance") != trust_framework:
+        raise Exception("Unexpected trust framework in Merkle proof")
+    if not proof["layers"]:
+        raise Exception("Merkle proof has no layers")
+    certificates_from_record = proof.get("certificates") or {}
+    leaf = step_leaf(proof["step"])
+    signers = []
+    for layer in proof["layers"]:
+        root = root_from_path(leaf, layer["index"], layer["count"], list(map(_decode_hash, layer["siblings"])))
+        container_format_version, serial, sign_timestamp, signature = layer["signature"]
+        if str(int(serial)) != serial:
+            raise Exception("Bad certificate serial number in Merkle proof: "+serial)
+        signers.append(certificate_provider._verify(
+            certificates_from_record,
+            serial,
+            sign_timestamp,
+            commitment_data_for_signing(trust_framework, root, container_format_version, serial, sign_timestamp),
+            base64.urlsafe_b64decode(layer["commitment"])
+        ))
+        leaf = layer_leaf(root, layer["signature"])
+    step = json.loads(base64.urlsafe_b64decode(proof["step"]))
+    step["_signature"] = {
+        "signed": signers[0],
+        "includedBy": list(reversed(signers[1:]))
+    }
+    return step
@@ -0,0 +1,213 @@
+import base64
+import concurrent.futures
+
+from ib1.provenance.record import CURRENT_CONTAINER_FORMAT_VERSION
+
+from .cache import layer_digest, provider_identity
+from .certificates import certificates_subset, chain_digest
+
+# ---------------------------------------------------------------------------
+
+class LayerResult:
+
+    # Outcome of checking the signature on one signed layer. path is the
+    # position of the layer within the record's steps, as a list of indexes.
+
+    def __init__(self, record_index, path, serial, sign_timestamp, signer_info=None, error=None):
+        self.record_index = record_index
+        self.path = path
+        self.serial = serial
+        self.sign_timestamp = sign_timestamp
+        self.signer_info = signer_info
+        self.error = error
+        self.digest = None
+        self.chain = None
+
+    def valid(self):
+        return self.error is None
+
+    def to_dict(self):
+        return {
+            "record": self.record_index,
+            "path": self.path,
+            "serial": self.serial,
+            "timestamp": self.sign_timestamp,
+            "signed": self.signer_info,
+            "error": None if self.error is None else str(self.error)
+        }
+
+
+class VerificationResult:
+
+    def __init__(self, record_count, layers):
+        self.record_count = record_count
+        self.layers = layers
+
+    def valid(self):
+        return all(map(lambda l: l.valid(), self.layers))
+
+    def record_valid(self, record_index):
+        return all(map(lambda l: l.valid(), self.layers_for_record(record_index)))
+
+    def layers_for_record(self, record_index):
+        return list(filter(lambda l: l.record_index == record_index, self.layers))
+
+    def errors(self):
+        return list(filter(lambda l: not l.valid(), self.layers))
+
+# ---------------------------------------------------------------------------
+
+class ParallelVerifier:
+
+    # Checks the signatures of every layer of one or more records on a pool
+    # of workers. The layers of a record are independent once the data they
+    # sign has been extracted, so all layers of all records are verified at
+    # once.
+    #
+    # provider_factory is a callable returning a certificate provider, for
+    # example functools.partial(CertificatesProviderSelfContainedRecord, ca_file).
+    # With processes=True it must be picklable, and is called once in each
+    # worker process. Otherwise a single provider is shared by the threads.
+    #
+    # As Record.verify(), each record's origins must match its origin steps.
+    # If they don't, the record's outermost layer fails.
+    #
+    # If a VerifiedLayerCache is given, layers already in it are not checked
+    # again and every layer which verifies is added to it, so records using
+    # the same cache will then verify() without checking any signatures.
+
+    def __init__(self, provider_factory, max_workers=None, processes=False, verification_cache=None):
+        self._provider_factory = provider_factory
+        self._max_workers = max_workers
+        self._processes = processes
+        self._verification_cache = verification_cache
+
+    def verify(self, record):
+        return self.verify_records([record])
+
+    def verify_records(self, records):
+        jobs = {}   # chain digest + layer digest -> (result, job)
+        results = []
+        # Identical layers with the same signer chain, such as shared upstream
+        # records, are only checked once
+        duplicates = []
+        provider = None if self._processes and self._verification_cache is None else self._provider_factory()
+        # Cached layers are only used if checked against the same root CA
+        identity = provider_identity(provider) if self._verification_cache is not None else None
+        certificate_cache = provider.certificate_cache() if hasattr(provider, "certificate_cache") else None
+        for record_index, record in enumerate(records):
+            encoded = record.encoded()
+            certificates_from_record = encoded.get("certificates")
+            if certificates_from_record is None:
+                certificates_from_record = {}
+            self._collect_jobs(record, record_index, encoded["steps"], [], certificates_from_record, {}, {}, certificate_cache, jobs, duplicates, results, identity)
+        if jobs:
+            if self._processes:
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self._max_workers,
+                    initializer=_initialise_worker,
+                    initargs=(self._provider_factory,)
+                )
+                verify_job = _verify_job_in_worker
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers)
+                def verify_job(job):
+                    return _verify_job(provider, job)
+            with executor:
+                outcomes = list(executor.map(verify_job, map(lambda j: j[1], jobs.values())))
+            for (result, job), (signer_info, error) in zip(jobs.values(), outcomes):
+                result.signer_info = signer_info
+                result.error = error
+                if error is None and identity is not None:
+                    self._verification_cache.put(identity, result.chain, result.digest, signer_info)
+        for result, original in duplicates:
+            result.signer_info = original.signer_info
+            result.error = original.error
+        # The origins list isn't signed, so is checked against the steps
+        for record_index, record in enumerate(records):
+            encoded = record.encoded()
+            origins = []
+            error = None
+            try:
+                record._gather_origins(encoded["steps"], origins)
+            except Exception as e:
+                # A step which can't be decoded
+                error = e
+            if error is None and encoded["origins"] != origins:
+                error = Exception("origins property does not match origin steps in record")
+            if error is not None:
+                outermost = next(filter(lambda r: r.record_index == record_index and r.path == [], results))
+                if outermost.error is None:
+                    outermost.error = error
+        return VerificationResult(len(records), results)
+
+    def _collect_jobs(self, record, record_index, container, path, certificates_from_record, digests, chains, certificate_cache, jobs, duplicates, results, identity):
+        *data, sig_block = container
+        container_format_version, serial, sign_timestamp, signature = sig_block
+        result = LayerResult(record_index, path, serial, sign_timestamp)
+        results.append(result)
+        for index, e in enumerate(data):
+            if not isinstance(e, str):
+                self._collect_jobs(record, record_index, e, path + [index], certificates_from_record, digests, chains, certificate_cache, jobs, duplicates, results, identity)
+        # Same checks on the signature block as Record.verify()
+        if container_format_version != CURRENT_CONTAINER_FORMAT_VERSION:
+            result.error = Exception("Cannot decode container format version: "+str(container_format_version))
+            return
+        if str(int(serial)) != serial:
+            result.error = Exception("Bad certificate serial number in record: "+serial)
+            return
+        # The certificates section isn't signed, so a layer is only taken as
+        # verified with the same signer chain
+        if serial not in chains:
+            try:
+                chains[serial] = chain_digest(certificates_from_record, serial, certificate_cache)
+            except Exception as e:
+                result.error = e
+                return
+        result.chain = chains[serial]
+        result.digest = layer_digest(record.trust_framework, container, digests)
+        if identity is not None:
+            signer_info = self._verification_cache.get(identity, result.chain, result.digest)
+            if signer_info is not None:
+                result.signer_info = signer_info
+                return
+        key = result.chain + result.digest
+        if key in jobs:
+            duplicates.append((result, jobs[key][0]))
+            return
+        data_for_signing = record._data_for_signing(data, [str(container_format_version), serial, sign_timestamp])
+        jobs[key] = (result, (
+            certificates_subset(certificates_from_record, serial),
+            serial,
+            sign_timestamp,
+            data_for_signing.encode("utf-8"),
+            base64.urlsafe_b64decode(signature)
+        ))
+
+
+def _verify_job(provider, job):
+    certificates_from_record, serial, sign_timestamp, data, signature = job
+    try:
+        return (provider._verify(certificates_from_record, serial, sign_timestamp, data, signature), None)
+    except Exception as e:
+        return (None, e)
+
+# ---------------------------------------------------------------------------
+
+_worker_provider = None
+
+
+def _initialise_worker(provider_factory):
+    global _worker_provider
+    _worker_provider = provider_factory()
+
+
+def _verify_job_in_worker(job):
+    signer_info, error = _verify_job(_worker_provider, job)
+    # Exceptions from the crypto libraries don't always pickle
+    if error is not None:
+        message = type(error).__name__
+        if str(error):
+            message += ": " + str(error)
+        error = Exception(message)
+    return (signer_info, error)
@@ -0,0 +1,227 @@
+import datetime
+
+from cryptography import x509
+
+from .view import RecordView
+from .certificates import certificates_for_serial, DEFAULT_CERTIFICATE_CACHE
+
+# ---------------------------------------------------------------------------
+
+def _utc(t):
+    # Times without a timezone are taken to be UTC
+    if t.tzinfo is None:
+        return t.replace(tzinfo=datetime.timezone.utc)
+    return t.astimezone(datetime.timezone.utc)
+
+
+def _parse_timestamp(timestamp):
+    # ISO 8601 date or date and time, as UTC
+    if not isinstance(timestamp, str):
+        raise ValueError("Timestamp is not a string")
+    return _utc(datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00")))
+
+
+def _issuer_key(issuer):
+    # issuer is an x509.Name or the issuer's x509.Certificate
+    if isinstance(issuer, x509.Certificate):
+        issuer = issuer.subject
+    return issuer.public_bytes()
+
+# ---------------------------------------------------------------------------
+
+class RevocationList:
+
+    # Revoked certificates, held in a hash table so each check takes
+    # constant time however many certificates are revoked. Serials are only
+    # unique for each issuer, so certificates are identified by the DER
+    # encoded name of their issuer and their serial, as a string as in
+    # records.
+    #
+    # data attributes:
+    #   _revoked -- (issuer name DER, serial) -> datetime of revocation, or None if not known
+
+    def __init__(self, revoked=None):
+        self._revoked = dict(revoked) if revoked is not None else {}
+
+    @classmethod
+    def from_serials(cls, issuer, serials):
+        # issuer is an x509.Name or the issuer's x509.Certificate
+        issuer_key = _issuer_key(issuer)
+        return cls({(issuer_key, str(s)): None for s in serials})
+
+    @classmethod
+    def from_crl(cls, data, issuer_certificates=None):
+        # data is a PEM or DER encoded CRL. If issuer certificates are given,
+        # the CRL must be signed by one of them.
+        if data.lstrip().startswith(b"-----BEGIN"):
+            crl = x509.load_pem_x509_crl(data)
+        else:
+            crl = x509.load_der_x509_crl(data)
+        if issuer_certificates is not None:
+            if not any(map(lambda c: c.subject == crl.issuer and crl.is_signature_valid(c.public_key()), issuer_certificates)):
+                raise Exception("CRL is not signed by a trusted issuer")
+        issuer_key = _issuer_key(crl.issuer)
+        return cls({(issuer_key, str(r.serial_number)): r.revocation_date_utc for r in crl})
+
+    @classmethod
+    def from_crl_file(cls, path, issuer_certificates=None):
+        with open(path, "rb") as f:
+            return cls.from_crl(f.read(), issuer_certificates)
+
+    def update(self, other):
+        self._revoked.update(other._revoked)
+
+    def __len__(self):
+        return len(self._revoked)
+
+    def __contains__(self, certificate):
+        return self._certificate_key(certificate) in self._revoked
+
+    def is_revoked(self, certificate, evaluation_time=None):
+        # certificate is an x509.Certificate, or a tuple of issuer and serial.
+        # Revoked at or before the evaluation time, if given.
+        key = self._certificate_key(certificate)
+        if key not in self._revoked:
+            return False
+        revoked_at = self._revoked[key]
+        return evaluation_time is None or revoked_at is None or revoked_at <= _utc(evaluation_time)
+
+    def _certificate_key(self, certificate):
+        if isinstance(certificate, x509.Certificate):
+            return (certificate.issuer.public_bytes(), str(certificate.serial_number))
+        issuer, serial = certificate
+        return (issuer if isinstance(issuer, bytes) else _issuer_key(issuer), str(serial))
+
+# ---------------------------------------------------------------------------
+
+class PolicyResult:
+
+    # Outcome of checking a verified record against permission expiry and
+    # certificate revocation at an evaluation time, or against revocation
+    # alone if there is no evaluation time
+    #
+    # data attributes:
+    #   expired_permissions -- ids of permission steps expired at the evaluation time
+    #   unreadable_expiry -- ids of permission steps whose expires isn't an ISO 8601 date or time
+    #   unreadable_timestamps -- ids of steps using permissions whose timestamp isn't an ISO 8601 date or time
+    #   steps_using_expired_permissions -- step id -> list of expired permission ids it relies on
+    #   steps_after_expiry -- step id -> list of permission ids which expired before the step's timestamp
+    #   revoked_signers -- list of dicts describing layers signed with a revoked certificate chain
+
+    def __init__(self, evaluation_time):
+        self.evaluation_time = evaluation_time
+        self.expired_permissions = []
+        self.unreadable_expiry = []
+        self.unreadable_timestamps = []
+        self.steps_using_expired_permissions = {}
+        self.steps_after_expiry = {}
+        self.revoked_signers = []
+
+    def valid(self):
+        return not (self.expired_permissions or self.unreadable_expiry or self.unreadable_timestamps or self.steps_after_expiry or self.revoked_signers)
+
+    def failed_steps(self):
+        failed = list(self.expired_permissions)
+        failed.extend(self.unreadable_expiry)
+        failed.extend(self.unreadable_timestamps)
+        failed.extend(self.steps_using_expired_permissions.keys())
+        failed.extend(self.steps_after_expiry.keys())
+        for r in self.revoked_signers:
+            failed.extend(r["steps"])
+        return list(dict.fromkeys(failed))
+
+    def summary(self):
+        problems = []
+        if self.expired_permissions:
+            problems.append(str(len(self.expired_permissions))+" expired permissions")
+        if self.unreadable_expiry:
+            problems.append(str(len(self.unreadable_expiry))+" permissions with unreadable expiry times")
+        if self.unreadable_timestamps:
+            problems.append(str(len(self.unreadable_timestamps))+" steps with unreadable timestamps")
+        if self.steps_after_expiry:
+            problems.append(str(len(self.steps_after_expiry))+" steps made after their permissions expired")
+        if self.revoked_signers:
+            problems.append(str(len(self.revoked_signers))+" layers signed with revoked certificates ("+", ".join(map(lambda r: r["revoked"], self.revoked_signers))+")")
+        return "; ".join(problems) if problems else "ok"
+
+    def to_dict(self):
+        return {
+            "evaluationTime": self.evaluation_time.isoformat() if self.evaluation_time is not None else None,
+            "expiredPermissions": self.expired_permissions,
+            "unreadableExpiry": self.unreadable_expiry,
+            "unreadableTimestamps": self.unreadable_timestamps,
+            "stepsUsingExpiredPermissions": self.steps_using_expired_permissions,
+            "stepsAfterExpiry": self.steps_after_expiry,
+            "revokedSigners": self.revoked_signers
+        }
+
+# ---------------------------------------------------------------------------
+
+def check_permission_expiry(steps, result):
+    # One pass to index permission expiry, one to check the steps using them
+    expires = {}
+    for step in steps:
+        if step["type"] == "permission" and "expires" in step:
+            try:
+                expires[step["id"]] = _parse_timestamp(step["expires"])
+            except ValueError:
+                result.unreadable_expiry.append(step["id"])
+                continue
+            if expires[step["id"]] <= result.evaluation_time:
+                result.expired_permissions.append(step["id"])
+    expired = set(result.expired_permissions)
+    for step in steps:
+        permission_ids = step.get("permissions", [])
+        if not permission_ids:
+            continue
+        using_expired = [p for p in permission_ids if p in expired]
+        if using_expired:
+            result.steps_using_expired_permissions[step["id"]] = using_expired
+        try:
+            step_time = _parse_timestamp(step.get("timestamp"))
+        except ValueError:
+            result.unreadable_timestamps.append(step["id"])
+            continue
+        after_expiry = [p for p in permission_ids if p in expires and expires[p] < step_time]
+        if after_expiry:
+            result.steps_after_expiry[step["id"]] = after_expiry
+    return result
+
+
+def check_revocation(encoded_record, revocation_list, result, certificate_cache=None):
+    if certificate_cache is None:
+        certificate_cache = DEFAULT_CERTIFICATE_CACHE
+    certificates_from_record = encoded_record.get("certificates") or {}
+    chains = {}
+    for layer in RecordView(encoded_record).layers():
+        if layer.serial not in chains:
+            # The signing certificate and its issuers, as verified
+            chains[layer.serial] = [c for c in certificates_for_serial(certificates_from_record, layer.serial, certificate_cache)
+                                    if revocation_list.is_revoked(c, result.evaluation_time)]
+        if chains[layer.serial]:
+            revoked = chains[layer.serial][0]
+            result.revoked_signers.append({
+                "serial": layer.serial,
+                "revoked": str(revoked.serial_number),
+                "issuer": revoked.issuer.rfc4514_string(),
+                "path": layer.path,
+                "timestamp": layer.sign_timestamp,
+                "steps": list(layer.step_ids)
+            })
+    return result
+
+
+def check_policy(record, evaluation_time=None, revocation_list=None, certificate_cache=None):
+    # record is a verified Record. Permission expiry is checked if an
+    # evaluation_time is given, and if a RevocationList is given, every
+    # certificate in every signer's chain is checked against it, counting
+    # revocations up to evaluation_time, or all of them without one.
+    if evaluation_time is not None:
+        evaluation_time = _utc(evaluation_time)
+    record._require_verified()
+    result = PolicyResult(evaluation_time)
+    if evaluation_time is not None:
+        check_permission_expiry(record._verified, result)
+    if revocation_list is not None:
+        check_revocation(record.encoded(), revocation_list, result, certificate_cache)
+    return result
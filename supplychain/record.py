@@ -0,0 +1,392 @@
+import copy
+import json
+import base64
+
+from ib1 import provenance
+from ib1.provenance.record import CURRENT_CONTAINER_FORMAT_VERSION
+
+from .cache import layer_digest, provider_identity
+from .instrument import span
+from .policy import check_policy
+from .compact import CompactStep, CompactStepBuilder
+from .view import RecordView
+from .lineage import LineageIndex
+from .graph import write_graphviz, write_graph_jsonl
+from .merkle import layer_leaves, merkle_root, merkle_proof, commitment_data_for_signing, commitment_entry, checked_commitments
+from .certificates import chain_digest, empty_certificates, merge_certificates, add_certificate_chain, legacy_certificates
+
+
+class Record(provenance.Record):
+
+    # ib1.provenance.Record with the extensions used by the supply chain
+    # scenarios. Records returned by sign() are of this class too.
+    #
+    # additional data attributes:
+    #   _verification_cache -- VerifiedLayerCache of already checked signed layers, or None
+    #   _layer_digests -- memo of layer digests during verify()
+    #   _chain_digests -- memo of signer chain digests by serial during verify()
+    #   _compact -- whether verified steps are kept as CompactSteps
+    #   _step_builder -- CompactStepBuilder during verify() if _compact
+    #   _origins_checked -- whether _record's origins are known to match its steps
+    #   _checked_origins -- id() of each added record whose origins are known to match its steps
+    #   _commitments_checked -- whether _record's merkle section has only checked entries
+
+    def __init__(self, trust_framework, record=None, verification_cache=None, compact=False):
+        # With compact=True, verified steps are kept as CompactSteps, which
+        # take much less memory for large records. decoded() still returns
+        # dicts, and steps() the CompactSteps without copying.
+        super().__init__(trust_framework, record)
+        self._verification_cache = verification_cache
+        self._layer_digests = None
+        self._chain_digests = None
+        self._compact = compact
+        self._step_builder = None
+        self._origins_checked = False
+        self._checked_origins = set()
+        self._commitments_checked = False
+
+    def verify(self, certificate_provider, evaluation_time=None, revocation_list=None):
+        # If an evaluation time is given, also checks permission expiry, and
+        # if a RevocationList is given, certificate revocation, see check_policy()
+        self._layer_digests = {}
+        self._chain_digests = {}
+        self._step_builder = CompactStepBuilder() if self._compact else None
+        try:
+            with span("verify") as s:
+                super().verify(certificate_provider)
+                s.set("steps", len(self._verified))
+            self._origins_checked = True
+            self._check_commitments(certificate_provider)
+        finally:
+            self._layer_digests = None
+            self._chain_digests = None
+            self._step_builder = None
+        if evaluation_time is not None or revocation_list is not None:
+            certificate_cache = certificate_provider.certificate_cache() if hasattr(certificate_provider, "certificate_cache") else None
+            result = self.check_policy(evaluation_time, revocation_list, certificate_cache)
+            if not result.valid():
+                self._verified = None
+                raise Exception("Record does not meet policy: "+result.summary())
+
+    def _check_commitments(self, certificate_provider):
+        # Drops Merkle commitments which don't match their layers, without
+        # changing the encoded record this Record was made from
+        if "merkle" in self._record:
+            certificate_cache = certificate_provider.certificate_cache() if hasattr(certificate_provider, "certificate_cache") else None
+            checked = checked_commitments(self.trust_framework, self._record, certificate_cache)
+            if checked != self._record["merkle"]:
+                self._record = dict(self._record)
+                if checked:
+                    self._record["merkle"] = checked
+                else:
+                    del self._record["merkle"]
+        self._commitments_checked = True
+
+    def check_policy(self, evaluation_time=None, revocation_list=None, certificate_cache=None):
+        # PolicyResult listing expired permissions, the steps relying on them,
+        # and layers signed with revoked certificates
+        with span("check_policy"):
+            return check_policy(self, evaluation_time, revocation_list, certificate_cache)
+
+    def _verify_record_container(self, container, certificates_from_record, certificate_provider, steps, origins, signer_stack):
+        *data, sig_block = container
+        with span("verify.layer", serial=sig_block[1], depth=len(signer_stack)) as s:
+            signer_info = self._verify_layer_signature(container, certificates_from_record, certificate_provider, s)
+        layer = self._step_builder.layer(signer_info, signer_stack) if self._step_builder is not None else None
+        # Recurse into signed data, collecting decoded steps and adding signer info
+        for e in data:
+            if not isinstance(e, str):
+                signer_stack.append(signer_info)
+                self._verify_record_container(e, certificates_from_record, certificate_provider, steps, origins, signer_stack)
+                del signer_stack[-1]
+            else:
+                decoded_step = self._decode_step(e)
+                if decoded_step["type"] == "origin":
+                    origins.append(decoded_step["id"])
+                if layer is not None:
+                    steps.append(self._step_builder.step(decoded_step, layer))
+                    continue
+                decoded_step["_signature"] = {
+                    "signed": signer_info,
+                    "includedBy": copy.copy(signer_stack)
+                }
+                steps.append(decoded_step)
+
+    def _verify_layer_signature(self, container, certificates_from_record, certificate_provider, layer_span):
+        *data, sig_block = container
+        container_format_version, serial, sign_timestamp, signature = sig_block
+        # Check it's an understood format (multiple versions of formats may be included in a single record)
+        if container_format_version != CURRENT_CONTAINER_FORMAT_VERSION:
+            raise Exception("Cannot decode container format version: "+str(container_format_version))
+        # Serial number must only be a number
+        if str(int(serial)) != serial:
+            raise Exception("Bad certificate serial number in record: "+serial)
+        # A layer already verified (typically by the previous hop's checks)
+        # with the same certificate chain only needs a lookup
+        digest = None
+        identity = provider_identity(certificate_provider) if self._verification_cache is not None else None
+        if identity is not None:
+            if serial not in self._chain_digests:
+                certificate_cache = certificate_provider.certificate_cache() if hasattr(certificate_provider, "certificate_cache") else None
+                self._chain_digests[serial] = chain_digest(certificates_from_record, serial, certificate_cache)
+            chain = self._chain_digests[serial]
+            digest = layer_digest(self.trust_framework, container, self._layer_digests)
+            signer_info = self._verification_cache.get(identity, chain, digest)
+            layer_span.set("cache", "miss" if signer_info is None else "hit")
+            if signer_info is not None:
+                return signer_info
+        data_for_signing = self._data_for_signing(data, [str(container_format_version), serial, sign_timestamp]).encode("utf-8")
+        layer_span.set("bytes", len(data_for_signing))
+        with span("verify.signature"):
+            signer_info = certificate_provider._verify(certificates_from_record, serial, sign_timestamp, data_for_signing, base64.urlsafe_b64decode(signature))
+        if digest is not None:
+            self._verification_cache.put(identity, chain, digest, signer_info)
+        return signer_info
+
+    def _decode_step(self, encoded_step):
+        # Spans for each step, split between base64 and JSON decoding
+        with span("decode_step", bytes=len(encoded_step)):
+            with span("decode_step.base64"):
+                data = base64.urlsafe_b64decode(encoded_step)
+            with span("decode_step.json"):
+                return json.loads(data)
+
+    def _encode_step(self, step):
+        # As ib1.provenance, with spans as _decode_step()
+        with span("encode_step", type=step.get("type")) as s:
+            with span("encode_step.json"):
+                data = json.dumps(step, separators=(",", ":")).encode("utf-8")
+            with span("encode_step.base64"):
+                encoded = base64.urlsafe_b64encode(data).decode("utf-8")
+            s.set("bytes", len(encoded))
+        return encoded
+
+    def add_record(self, record):
+        super().add_record(record)
+        if record._verified is not None or getattr(record, "_origins_checked", False):
+            self._checked_origins.add(id(self._additional_records[-1]))
+
+    def add_records(self, records, verifier=None):
+        # Adds many records at once, as add_record() for each of them. A
+        # record which is identical to another, or to a signed layer inside
+        # another, is only included once. Certificates shared between records
+        # are stored once when signed.
+        #
+        # If verifier (a ParallelVerifier) is given, all the records are
+        # checked first on its pool of workers, with each distinct layer
+        # checked once. Records are only added if all of them are valid.
+        # Otherwise the origins of any record which hasn't been verified are
+        # checked against its steps. Returns the number of the given records
+        # which were added.
+        records = list(records)
+        for index, r in enumerate(records):
+            if not isinstance(r, provenance.Record):
+                raise Exception("Not a Record object")
+            if self.trust_framework != r.trust_framework:
+                raise Exception("Incompatible trust frameworks in added Record")
+            if verifier is None and r._verified is None and not getattr(r, "_origins_checked", False):
+                origins = []
+                r._gather_origins(r.encoded()["steps"], origins)
+                if r.encoded()["origins"] != origins:
+                    raise Exception("Added Record "+str(index)+" origins property does not match origin steps in record")
+        if verifier is not None:
+            verification = verifier.verify_records(records)
+            if not verification.valid():
+                failed = verification.errors()[0]
+                raise Exception("Added Record "+str(failed.record_index)+" failed verification: "+(str(failed.error) or type(failed.error).__name__))
+        digests = {}
+        included = set()
+        if self._record is not None:
+            self._collect_layer_digests(self._record["steps"], digests, included, True)
+        candidates = self._additional_records + list(map(lambda r: r.encoded(), records))
+        tops = list(map(lambda e: layer_digest(self.trust_framework, e["steps"], digests), candidates))
+        for e in candidates:
+            self._collect_layer_digests(e["steps"], digests, included, False)
+        kept = []
+        added = 0
+        for index, (e, top) in enumerate(zip(candidates, tops)):
+            if top in included:
+                continue
+            included.add(top)
+            kept.append(e)
+            if index >= len(self._additional_records):
+                added += 1
+        if added or len(kept) != len(self._additional_records):
+            self._signed = False
+            self._verified = None
+        # Every record given has had its origins checked by now
+        checked = self._checked_origins | set(map(lambda r: id(r.encoded()), records))
+        self._additional_records = kept
+        self._checked_origins = checked & set(map(id, kept))
+        return added
+
+    def _collect_layer_digests(self, container, digests, included, include_container):
+        if include_container:
+            included.add(layer_digest(self.trust_framework, container, digests))
+        for e in container[:-1]:
+            if not isinstance(e, str):
+                self._collect_layer_digests(e, digests, included, True)
+
+    def sign(self, signer, structured_certificates=True, merkle_commitment=False):
+        # As ib1.provenance.Record.sign(), but merges the certificates from
+        # records in either form, and by default writes the structured form.
+        # Use structured_certificates=False for recipients using ib1.provenance.
+        # With merkle_commitment=True, the signer also commits to a Merkle
+        # root over the new layer, so proofs for single steps can be made
+        # with merkle_proof() (at the cost of a second signature).
+        #
+        # Already signed layers are appended as they are, without copying or
+        # decoding their steps, so the cost of adding a layer doesn't depend
+        # on the size of the records inside it. The origins property isn't
+        # signed, so it is only reused from records which have been verified
+        # or were made by sign(), and otherwise gathered from the steps as
+        # ib1.provenance does. The returned record shares
+        # those layers with the records it was made from, which must not be
+        # modified (any change would invalidate their signatures anyway).
+        with span("sign", steps=len(self._additional_steps), records=len(self._additional_records)) as sign_span:
+            output = []
+            origins = []
+            certificates = empty_certificates()
+            commitments = {}
+            with span("sign.merge"):
+                for r in ([self._record] if self._record is not None else []) + self._additional_records:
+                    merge_certificates(certificates, r.get("certificates"))
+                    if r is self._record and self._commitments_checked:
+                        commitments.update(r.get("merkle", {}))
+                    else:
+                        commitments.update(checked_commitments(self.trust_framework, r))
+                    if r is self._record and self._origins_checked or id(r) in self._checked_origins:
+                        origins.extend(r["origins"])
+                    else:
+                        self._gather_origins(r["steps"], origins)
+                    output.append(r["steps"]) # signed and encoded
+            with span("sign.encode_steps") as s:
+                for step in self._additional_steps:
+                    output.append(self._encode_step(step)) # unencoded, not signed
+                    if step["type"] == "origin":
+                        origins.append(step["id"])
+                s.set("bytes", sum(map(len, output[len(output)-len(self._additional_steps):])))
+            serial = signer.serial()
+            sign_timestamp = self._timestamp_now_iso8601()
+            if merkle_commitment:
+                with span("sign.merkle"):
+                    root = merkle_root(layer_leaves(output, commitments))
+                    commitment_signature = signer.sign(commitment_data_for_signing(self.trust_framework, root, CURRENT_CONTAINER_FORMAT_VERSION, serial, sign_timestamp))
+            with span("sign.data_for_signing") as s:
+                data_for_signing = self._data_for_signing(output, [str(CURRENT_CONTAINER_FORMAT_VERSION), serial, sign_timestamp]).encode("utf-8")
+                s.set("bytes", len(data_for_signing))
+            with span("sign.signature"):
+                signature = signer.sign(data_for_signing)
+            output.append([
+                CURRENT_CONTAINER_FORMAT_VERSION,
+                serial,
+                sign_timestamp,
+                base64.urlsafe_b64encode(signature).decode('utf-8')
+            ])
+            if merkle_commitment:
+                commitments[output[-1][3]] = commitment_entry(root, commitment_signature)
+            if serial not in certificates["chains"]:
+                certs_for_record = signer.certificates_for_record()
+                if certs_for_record is not None:
+                    add_certificate_chain(certificates, serial, certs_for_record)
+            # Certificates come before the steps, so that a RecordStreamReader
+            # can verify each layer as soon as it has been read
+            encoded = {
+                "ib1:provenance": self.trust_framework,
+                "origins": origins
+            }
+            if certificates["chains"]:
+                encoded["certificates"] = certificates if structured_certificates else legacy_certificates(certificates)
+            if commitments:
+                encoded["merkle"] = commitments
+            encoded["steps"] = output
+            sign_span.set("serial", serial)
+        signed = Record(self.trust_framework, encoded, self._verification_cache, self._compact)
+        signed._origins_checked = True
+        signed._commitments_checked = True
+        return signed
+
+    def _data_for_signing(self, data, additional=None, is_root=True):
+        # As ib1.provenance.Record._data_for_signing(), but nested layers add
+        # their parts to a single list, so the data is made with one join
+        # instead of a join and a copy at every level of nesting
+        gather = [self.trust_framework] if is_root else []
+        self._gather_data_for_signing(data, gather)
+        if additional is not None:
+            gather.extend(additional)
+        return ".".join(gather)
+
+    def _gather_data_for_signing(self, data, gather):
+        for e in data:
+            if isinstance(e, str):
+                gather.append(e)
+            elif isinstance(e, int):
+                gather.append(str(e))
+            else:
+                gather.append("%")
+                if e:
+                    self._gather_data_for_signing(e, gather)
+                else:
+                    gather.append("") # as joining an empty list
+                gather.append("&")
+
+    def add_step(self, step_in):
+        with span("add_step", type=step_in.get("type")):
+            return super().add_step(step_in)
+
+    def encoded(self):
+        with span("encoded"):
+            return super().encoded()
+
+    def decoded(self):
+        with span("decoded") as s:
+            if self._compact:
+                self._require_verified()
+                memo = {}
+                decoded = list(map(lambda step: step.to_dict(memo), self._verified))
+            else:
+                decoded = super().decoded()
+            s.set("steps", len(decoded))
+            return decoded
+
+    def steps(self):
+        # The verified steps without copying them, which must not be modified.
+        # CompactSteps if the Record was made with compact=True.
+        self._require_verified()
+        return self._verified
+
+    def _filter_step_contains(self, step, required_values):
+        # ib1.provenance only matches dicts
+        if isinstance(step, CompactStep):
+            step = dict(step)
+        return super()._filter_step_contains(step, required_values)
+
+    def to_graphviz(self):
+        with span("to_graphviz") as s:
+            dot = super().to_graphviz()
+            s.set("bytes", len(dot))
+            return dot
+
+    def view(self, verification=None):
+        # Lazily decoded view of the steps, see RecordView
+        return RecordView(self.encoded(), verification)
+
+    def merkle_proof(self, step_id):
+        # Proof that a single step is in this record, see supplychain.merkle
+        return merkle_proof(self.encoded(), step_id)
+
+    def write_graphviz(self, out, clusters="member"):
+        # As to_graphviz(), written to out as it goes, see supplychain.graph
+        self._require_verified()
+        with span("write_graphviz", steps=len(self._verified)):
+            write_graphviz(self._verified, out, clusters)
+
+    def write_graph_jsonl(self, out, clusters="member"):
+        self._require_verified()
+        with span("write_graph_jsonl", steps=len(self._verified)):
+            write_graph_jsonl(self._verified, out, clusters)
+
+    def lineage(self):
+        # Index for lineage queries over the verified steps, see LineageIndex
+        self._require_verified()
+        return LineageIndex(self._verified, self._record["origins"])
@@ -0,0 +1,295 @@
+# Declarative supply chain scenarios, run as a graph of participants.
+#
+# A scenario is a JSON (or YAML, if PyYAML is installed) document:
+#
+#   {
+#     "trustFramework": "https://registry.core.trust.ib1.org/trust-framework",
+#     "participants": {
+#       "metering": {
+#         "signer": "6-industrial-metering-company",
+#         "steps": {
+#           "origin": {"type": "origin", ...},
+#           "transfer": {"type": "transfer", "of": "@origin", ...}
+#         }
+#       },
+#       "manufacturer": {
+#         "signer": "7-nitrogen-fertiliser-products",
+#         "receives": "metering",
+#         "includes": [],
+#         "verify": true,
+#         "steps": {
+#           "receipt": {"type": "receipt", "transfer": "@metering.transfer"}
+#         }
+#       }
+#     },
+#     "final": "manufacturer"
+#   }
+#
+# Each participant starts from the record it receives from another
+# participant (or an empty record), verifies it unless "verify" is false,
+# adds the records of the participants it includes, adds its steps in
+# order, and signs with the named signer. In step values, "@name" is the id
+# of one of the participant's own steps, "@participant.name" the id of
+# another participant's step, and a string starting "@@" is a literal "@".
+#
+# Participants wait only for the participants they receive from, include
+# or refer to, so independent branches run at the same time.
+
+import sys
+import json
+import time
+import argparse
+import threading
+import concurrent.futures
+
+from .record import Record
+from .cache import VerifiedLayerCache
+
+# ---------------------------------------------------------------------------
+
+def load_scenario(path):
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".yaml") or path.endswith(".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise Exception("PyYAML is needed to read YAML scenarios")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def _references(value, found):
+    # Collects (participant or None, step name) for every reference in value
+    if isinstance(value, str):
+        if value.startswith("@") and not value.startswith("@@"):
+            participant, dot, name = value[1:].rpartition(".")
+            found.append((participant if dot else None, name))
+    elif isinstance(value, list):
+        for v in value:
+            _references(v, found)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _references(v, found)
+    return found
+
+
+def _resolve(value, resolve_reference):
+    if isinstance(value, str):
+        if value.startswith("@@"):
+            return value[1:]
+        if value.startswith("@"):
+            participant, dot, name = value[1:].rpartition(".")
+            return resolve_reference(participant if dot else None, name)
+        return value
+    if isinstance(value, list):
+        return list(map(lambda v: _resolve(v, resolve_reference), value))
+    if isinstance(value, dict):
+        return {k: _resolve(v, resolve_reference) for k, v in value.items()}
+    return value
+
+# ---------------------------------------------------------------------------
+
+class ParticipantResult:
+
+    # The signed record made by a participant, the ids given to its steps,
+    # and timings in seconds from the start of the run
+
+    def __init__(self, name):
+        self.name = name
+        self.record = None
+        self.step_ids = {}
+        self.ready = None
+        self.started = None
+        self.finished = None
+        self.verify_seconds = 0.0
+        self.sign_seconds = 0.0
+        self.thread = None
+
+    def seconds(self):
+        return self.finished - self.started
+
+    def waited(self):
+        # Time between all its inputs being ready and starting to run
+        return self.started - self.ready
+
+    def to_dict(self):
+        return {
+            "participant": self.name,
+            "steps": len(self.step_ids),
+            "ready": self.ready,
+            "started": self.started,
+            "finished": self.finished,
+            "seconds": self.seconds(),
+            "verify": self.verify_seconds,
+            "sign": self.sign_seconds,
+            "thread": self.thread
+        }
+
+
+class ScenarioResult:
+
+    def __init__(self, scenario, participants, seconds):
+        self._scenario = scenario
+        self.participants = participants
+        self.seconds = seconds
+
+    def record(self, participant=None):
+        # The final record of the scenario by default
+        return self.participants[participant if participant is not None else self._scenario["final"]].record
+
+    def timings(self):
+        # In the order participants finished
+        return list(map(
+            lambda p: p.to_dict(),
+            sorted(self.participants.values(), key=lambda p: p.finished)
+        ))
+
+# ---------------------------------------------------------------------------
+
+class ScenarioRunner:
+
+    # Runs a scenario, with participants whose inputs are ready running
+    # concurrently on a pool of max_workers threads. signers is a mapping of
+    # signer name to signer, such as a SignerRegistry.
+    #
+    # Each run() has a new VerifiedLayerCache, so repeated runs measure the
+    # same work. To share a cache between runs, pass it as verification_cache.
+
+    def __init__(self, scenario, signers, certificate_provider, max_workers=None, verification_cache=None):
+        self._scenario = scenario
+        self._signers = signers
+        self._certificate_provider = certificate_provider
+        self._max_workers = max_workers
+        self._verification_cache = verification_cache
+        self.trust_framework = scenario["trustFramework"]
+        self._participants = scenario["participants"]
+        self._dependencies = self._find_dependencies()
+
+    def _find_dependencies(self):
+        dependencies = {}
+        for name, participant in self._participants.items():
+            depends_on = set(participant.get("includes", []))
+            if participant.get("receives") is not None:
+                depends_on.add(participant["receives"])
+            for other, step_name in _references(participant.get("steps", {}), []):
+                if other is None:
+                    if step_name not in participant.get("steps", {}):
+                        raise Exception("Participant "+name+" refers to unknown step @"+step_name)
+                else:
+                    depends_on.add(other)
+            for other in depends_on:
+                if other not in self._participants:
+                    raise Exception("Participant "+name+" depends on unknown participant "+other)
+            if name in depends_on:
+                raise Exception("Participant "+name+" depends on itself")
+            dependencies[name] = depends_on
+        if self._scenario.get("final") not in self._participants:
+            raise Exception("Scenario final participant is not defined")
+        # Check the participants form a DAG
+        remaining = {n: set(d) for n, d in dependencies.items()}
+        while remaining:
+            ready = [n for n, d in remaining.items() if not d]
+            if not ready:
+                raise Exception("Scenario has a dependency cycle between participants: "+", ".join(sorted(remaining)))
+            for n in ready:
+                del remaining[n]
+            for d in remaining.values():
+                d.difference_update(ready)
+        return dependencies
+
+    def run(self):
+        start = time.perf_counter()
+        clock = lambda: time.perf_counter() - start
+        results = {name: ParticipantResult(name) for name in self._participants}
+        verification_cache = self._verification_cache if self._verification_cache is not None else VerifiedLayerCache()
+        waiting = {n: set(d) for n, d in self._dependencies.items()}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            running = {}
+            def submit_ready():
+                for n in [n for n, d in waiting.items() if not d]:
+                    del waiting[n]
+                    results[n].ready = clock()
+                    running[executor.submit(self._run_participant, n, results, clock, verification_cache)] = n
+            submit_ready()
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        for f in running:
+                            f.cancel()
+                        raise Exception("Scenario participant "+name+" failed: "+str(error)) from error
+                    for d in waiting.values():
+                        d.discard(name)
+                submit_ready()
+        return ScenarioResult(self._scenario, results, clock())
+
+    def _run_participant(self, name, results, clock, verification_cache):
+        participant = self._participants[name]
+        result = results[name]
+        result.started = clock()
+        result.thread = threading.current_thread().name
+        if participant.get("receives") is not None:
+            record = Record(self.trust_framework, results[participant["receives"]].record.encoded(), verification_cache)
+            if participant.get("verify", True):
+                verify_start = time.perf_counter()
+                record.verify(self._certificate_provider)
+                result.verify_seconds = time.perf_counter() - verify_start
+        else:
+            record = Record(self.trust_framework, None, verification_cache)
+        for included in participant.get("includes", []):
+            record.add_record(Record(self.trust_framework, results[included].record.encoded(), verification_cache))
+        def resolve_reference(other, step_name):
+            step_ids = result.step_ids if other is None else results[other].step_ids
+            if step_name not in step_ids:
+                raise Exception("Participant "+name+" refers to @"+(other+"." if other else "")+step_name+" before it is added")
+            return step_ids[step_name]
+        for step_name, step in participant.get("steps", {}).items():
+            result.step_ids[step_name] = record.add_step(_resolve(step, resolve_reference))
+        sign_start = time.perf_counter()
+        result.record = record.sign(self._signers[participant["signer"]])
+        result.sign_seconds = time.perf_counter() - sign_start
+        result.finished = clock()
+
+# ---------------------------------------------------------------------------
+
+def main(argv):
+    from .signers import SignerRegistry
+    from .certificates import CertificatesProviderSelfContainedRecord, CertificateCache
+    parser = argparse.ArgumentParser(description="Run a supply chain scenario")
+    parser.add_argument("scenario")
+    parser.add_argument("--keystore", default="certs")
+    parser.add_argument("--root-ca", default="certs/4-signing-ca-cert.pem")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--share-cache", action="store_true", help="keep verified layers and certificate chains cached between repeated runs")
+    parser.add_argument("--output", help="write the final encoded record to this file")
+    args = parser.parse_args(argv)
+    certificate_cache = CertificateCache()
+    certificate_provider = CertificatesProviderSelfContainedRecord(args.root_ca, certificate_cache)
+    runner = ScenarioRunner(
+        load_scenario(args.scenario),
+        SignerRegistry(certificate_provider, args.keystore),
+        certificate_provider,
+        args.workers,
+        VerifiedLayerCache() if args.share_cache else None
+    )
+    print("participant                           steps   ready ms   start ms  total ms  verify ms  sign ms")
+    for n in range(args.repeat):
+        if not args.share_cache:
+            certificate_cache.clear()
+        result = runner.run()
+        for t in result.timings():
+            print("%-36s %6d %10.3f %10.3f %9.3f %10.3f %8.3f" % (
+                t["participant"], t["steps"], t["ready"] * 1000, t["started"] * 1000,
+                t["seconds"] * 1000, t["verify"] * 1000, t["sign"] * 1000
+            ))
+        print("run %d: %.3f ms" % (n + 1, result.seconds * 1000))
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result.record().encoded(), f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
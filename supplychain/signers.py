@@ -0,0 +1,102 @@
+import os
+import threading
+
+from ib1.provenance.signing import SignerFiles
+
+from .cache import LRUCache
+
+
+CERTIFICATES_SUFFIX = "-cert-bundle.pem"
+KEY_SUFFIX = "-key.pem"
+
+# ---------------------------------------------------------------------------
+
+class SignerRegistry:
+
+    # Signers for the keys in a keystore directory, with the file names
+    # written by certmaker.sh and supplychain.certgen, <name>-cert-bundle.pem
+    # and <name>-key.pem, looked up by name like the dict in main.py.
+    #
+    # The directory is listed once, without reading any files. A signer's
+    # certificates and key are read and parsed when it is first used, and at
+    # most max_loaded signers are kept ready, least recently used dropped
+    # first. Signers may be looked up and used from many threads at once.
+    #
+    # data attributes:
+    #   _names -- set of signer names in the keystore
+    #   _loaded -- LRUCache of name -> SignerFiles
+    #   _loading -- name -> [Lock, number of threads using it], for signers being
+    #               loaded, so each signer is only loaded once at a time
+
+    def __init__(self, certificate_provider, directory, max_loaded=256):
+        self._certificate_provider = certificate_provider
+        self._directory = directory
+        self._loaded = LRUCache(max_loaded)
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.refresh()
+
+    def refresh(self):
+        # Index signers added to or removed from the keystore since
+        with os.scandir(self._directory) as entries:
+            filenames = set(map(lambda e: e.name, entries))
+        self._names = frozenset(
+            f[:-len(KEY_SUFFIX)] for f in filenames
+            if f.endswith(KEY_SUFFIX) and f[:-len(KEY_SUFFIX)]+CERTIFICATES_SUFFIX in filenames
+        )
+
+    def names(self):
+        return sorted(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __getitem__(self, name):
+        signer = self._loaded.get(name)
+        if signer is not None:
+            return signer
+        if name not in self._names:
+            raise KeyError("No signer "+name+" in keystore "+self._directory)
+        with self._lock:
+            loading = self._loading.get(name)
+            if loading is None:
+                loading = [threading.Lock(), 0]
+                self._loading[name] = loading
+            loading[1] += 1
+        try:
+            with loading[0]:
+                # Another thread may have loaded it while this one waited
+                if name in self._loaded:
+                    signer = self._loaded.get(name)
+                if signer is None:
+                    signer = SignerFiles(
+                        self._certificate_provider,
+                        os.path.join(self._directory, name+CERTIFICATES_SUFFIX),
+                        os.path.join(self._directory, name+KEY_SUFFIX)
+                    )
+                    self._loaded.put(name, signer)
+                    with self._lock:
+                        self.loads += 1
+        finally:
+            # Locks are only kept while in use, so memory depends on the
+            # signers being loaded rather than on every signer ever used
+            with self._lock:
+                loading[1] -= 1
+                if loading[1] == 0:
+                    del self._loading[name]
+        return signer
+
+    def get(self, name, default=None):
+        if name not in self._names:
+            return default
+        return self[name]
+
+    def stats(self):
+        return {"signers": len(self._names), "loaded": len(self._loaded), "loads": self.loads, "hits": self._loaded.hits}
@@ -0,0 +1,324 @@
+import re
+import json
+import base64
+import codecs
+import hashlib
+
+from ib1.provenance.record import CURRENT_CONTAINER_FORMAT_VERSION
+
+# ---------------------------------------------------------------------------
+
+class RecordStreamReader:
+
+    # Reads an encoded record in JSON form from a file-like object (anything
+    # with a read(size) method returning bytes, such as a file or
+    # socket.makefile("rb")) and yields its contents as they arrive, without
+    # holding the whole record in memory:
+    #
+    #   ("step", path, step) -- a decoded step, in the layer at path
+    #   ("signature", path, sig_block) -- the signature block ending a layer
+    #   ("verified", path, signer_info) -- a layer's signature has been checked
+    #
+    # path is the position of the layer within the steps, as a list of indexes.
+    #
+    # A certificate provider must have _verify_prehashed() (such as
+    # supplychain.certificates.CertificatesProviderSelfContainedRecord),
+    # because the data signed by a layer is never held to pass to _verify().
+    # Instead it is hashed as it is read, so only a digest per open layer
+    # is kept. A layer is verified as soon as its
+    # signature block is read if the certificates have already been read
+    # (supplychain.Record writes them before the steps) or the provider
+    # doesn't use the certificates in the record. Otherwise its digest and
+    # signature are kept until the certificates arrive. Any failure raises
+    # an Exception, and the origins property is checked at the end. Steps
+    # must not be relied on until the stream has been read to the end.
+
+    def __init__(self, source, trust_framework, certificate_provider=None, chunk_size=65536):
+        if certificate_provider is not None and not hasattr(certificate_provider, "_verify_prehashed"):
+            raise Exception("Certificate provider "+type(certificate_provider).__name__+" can't verify streamed records, "
+                            "use supplychain.certificates.CertificatesProviderSelfContainedRecord")
+        self.trust_framework = trust_framework
+        self._tokens = _Tokenizer(source, chunk_size)
+        self._certificate_provider = certificate_provider
+        self.certificates = None
+        self._pending = []
+        self._open_layers = []
+        self._origins_hash = hashlib.sha256()
+        self._origin_steps_hash = hashlib.sha256()
+        self._seen = set()
+
+    def events(self):
+        tokens = self._tokens
+        tokens.expect("{")
+        if not tokens.next_if("}"):
+            while True:
+                key = tokens.string()
+                tokens.expect(":")
+                self._seen.add(key)
+                match key:
+                    case "ib1:provenance":
+                        trust_framework = tokens.string()
+                        if trust_framework != self.trust_framework:
+                            raise Exception("Unexpected trust framework when creating Record from encoded form")
+                    case "origins":
+                        self._read_origins()
+                    case "steps":
+                        yield from self._read_container([])
+                    case "certificates":
+                        self.certificates = tokens.value()
+                        yield from self._verify_pending()
+                    case _:
+                        tokens.value()
+                if not tokens.next_if(","):
+                    break
+                tokens.expect_more()
+            tokens.expect("}")
+        tokens.expect_end()
+        for key in ("ib1:provenance", "origins", "steps"):
+            if key not in self._seen:
+                raise Exception("Not an encoded Provenance record")
+        if self._certificate_provider is not None:
+            if self.certificates is None:
+                self.certificates = {}
+            yield from self._verify_pending()
+        if self._origins_hash.digest() != self._origin_steps_hash.digest():
+            raise Exception("origins property does not match origin steps in record")
+
+    def _read_origins(self):
+        tokens = self._tokens
+        tokens.expect("[")
+        if tokens.next_if("]"):
+            return
+        while True:
+            self._origins_hash.update(tokens.string().encode("utf-8") + b"\0")
+            if not tokens.next_if(","):
+                break
+        tokens.expect("]")
+
+    def _read_container(self, path):
+        # The array has been opened when called for a nested container
+        tokens = self._tokens
+        if not path:
+            tokens.expect("[")
+        self._open_layer()
+        index = 0
+        while True:
+            if tokens.next_if("["):
+                if tokens.peek_number():
+                    sig_block = self._read_sig_block()
+                    tokens.expect("]")
+                    # The signature block is always last in the container
+                    tokens.expect("]")
+                    yield ("signature", path, sig_block)
+                    yield from self._close_layer(path, sig_block)
+                    return
+                self._feed_open_layers("%")
+                yield from self._read_container(path + [index])
+                self._feed_open_layers("&")
+            else:
+                encoded_step = tokens.string()
+                self._feed_open_layers(encoded_step)
+                step = json.loads(base64.urlsafe_b64decode(encoded_step))
+                if step["type"] == "origin":
+                    self._origin_steps_hash.update(step["id"].encode("utf-8") + b"\0")
+                yield ("step", path, step)
+            index += 1
+            tokens.expect(",")
+
+    def _read_sig_block(self):
+        tokens = self._tokens
+        sig_block = [tokens.value()]
+        while tokens.next_if(","):
+            sig_block.append(tokens.value())
+        if len(sig_block) != 4:
+            raise Exception("Bad signature block in record")
+        return sig_block
+
+    def _open_layer(self):
+        # Each layer's signed data starts with the trust framework, then
+        # every string in the layer, with nested arrays bracketed by % and &
+        h = hashlib.sha256(self.trust_framework.encode("utf-8"))
+        self._open_layers.append(h)
+
+    def _feed_open_layers(self, item):
+        encoded = b"." + item.encode("utf-8")
+        for h in self._open_layers:
+            h.update(encoded)
+
+    def _close_layer(self, path, sig_block):
+        container_format_version, serial, sign_timestamp, signature = sig_block
+        if container_format_version != CURRENT_CONTAINER_FORMAT_VERSION:
+            raise Exception("Cannot decode container format version: "+str(container_format_version))
+        if str(int(serial)) != serial:
+            raise Exception("Bad certificate serial number in record: "+serial)
+        h = self._open_layers.pop()
+        for item in (str(container_format_version), serial, sign_timestamp):
+            h.update(b"." + item.encode("utf-8"))
+        # Enclosing layers sign the signature block as a nested array
+        self._feed_open_layers("%")
+        for item in (str(container_format_version), serial, sign_timestamp, signature):
+            self._feed_open_layers(item)
+        self._feed_open_layers("&")
+        if self._certificate_provider is not None:
+            self._pending.append((path, serial, sign_timestamp, h.digest(), base64.urlsafe_b64decode(signature)))
+            if self.certificates is not None or not self._provider_uses_record_certificates():
+                yield from self._verify_pending()
+
+    def _provider_uses_record_certificates(self):
+        return self._certificate_provider.policy_include_certificates_in_record()
+
+    def _verify_pending(self):
+        certificates = self.certificates if self.certificates is not None else {}
+        pending = self._pending
+        self._pending = []
+        for path, serial, sign_timestamp, digest, signature in pending:
+            signer_info = self._certificate_provider._verify_prehashed(certificates, serial, sign_timestamp, digest, signature)
+            yield ("verified", path, signer_info)
+
+
+def read_record_stream(source, trust_framework, certificate_provider=None, chunk_size=65536):
+    return RecordStreamReader(source, trust_framework, certificate_provider, chunk_size).events()
+
+# ---------------------------------------------------------------------------
+
+class _Tokenizer:
+
+    # Incremental JSON tokenizer over a byte stream, holding only the
+    # unconsumed part of the current chunk and the token being read.
+
+    _NUMBER = re.compile(r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?")
+
+    def __init__(self, source, chunk_size):
+        self._source = source
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._position = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+        chunk = self._source.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            self._buffer = self._buffer[self._position:] + self._decoder.decode(b"", final=True)
+        else:
+            self._buffer = self._buffer[self._position:] + self._decoder.decode(chunk)
+        self._position = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in " \t\r\n":
+                self._position += 1
+            if self._position < len(self._buffer) or not self._fill():
+                return
+
+    def _peek_char(self):
+        self._skip_whitespace()
+        if self._position >= len(self._buffer):
+            return None
+        return self._buffer[self._position]
+
+    def expect(self, char):
+        c = self._peek_char()
+        if c != char:
+            raise Exception("Unexpected "+("end of record" if c is None else repr(c))+" in record, expected "+repr(char))
+        self._position += 1
+
+    def expect_more(self):
+        if self._peek_char() is None:
+            raise Exception("Unexpected end of record")
+
+    def expect_end(self):
+        if self._peek_char() is not None:
+            raise Exception("Unexpected data after end of record")
+
+    def next_if(self, char):
+        if self._peek_char() == char:
+            self._position += 1
+            return True
+        return False
+
+    def peek_number(self):
+        c = self._peek_char()
+        return c is not None and (c == "-" or c.isdigit())
+
+    def string(self):
+        self.expect('"')
+        search = self._position
+        while True:
+            end = self._buffer.find('"', search)
+            if end == -1:
+                # Read more, keeping the part of the string already scanned
+                scanned = len(self._buffer) - self._position
+                if not self._fill():
+                    raise Exception("Unterminated string in record")
+                search = scanned
+                continue
+            # A quote preceded by an odd number of backslashes is escaped
+            backslashes = 0
+            while end - 1 - backslashes >= self._position and self._buffer[end - 1 - backslashes] == "\\":
+                backslashes += 1
+            if backslashes % 2 == 0:
+                break
+            search = end + 1
+        raw = self._buffer[self._position:end]
+        self._position = end + 1
+        return json.loads('"' + raw + '"') if "\\" in raw else raw
+
+    def _number(self):
+        while True:
+            match = self._NUMBER.match(self._buffer, self._position)
+            if match is not None and (match.end() < len(self._buffer) or self._eof):
+                break
+            # The number may continue in the next chunk
+            if not self._fill():
+                break
+        if match is None:
+            raise Exception("Bad number in record")
+        self._position = match.end()
+        return json.loads(match.group(0))
+
+    def value(self):
+        c = self._peek_char()
+        if c is None:
+            raise Exception("Unexpected end of record")
+        if c == '"':
+            return self.string()
+        if c == "{":
+            self._position += 1
+            output = {}
+            if self.next_if("}"):
+                return output
+            while True:
+                key = self.string()
+                self.expect(":")
+                output[key] = self.value()
+                if not self.next_if(","):
+                    break
+            self.expect("}")
+            return output
+        if c == "[":
+            self._position += 1
+            output = []
+            if self.next_if("]"):
+                return output
+            while True:
+                output.append(self.value())
+                if not self.next_if(","):
+                    break
+            self.expect("]")
+            return output
+        if c == "-" or c.isdigit():
+            return self._number()
+        for literal, value in (("true", True), ("false", False), ("null", None)):
+            if self._buffer.startswith(literal[0], self._position):
+                while len(self._buffer) - self._position < len(literal) and self._fill():
+                    pass
+                if not self._buffer.startswith(literal, self._position):
+                    break
+                self._position += len(literal)
+                return value
+        raise Exception("Unexpected "+repr(c)+" in record")
@@ -0,0 +1,163 @@
+import re
+import copy
+import json
+import base64
+
+
+# Steps written by ib1.provenance start with the id, timestamp and type, so
+# these can be read by decoding a short prefix of the base64 encoded step.
+STEP_PREFIX_LENGTH = 128    # base64 characters, a multiple of 4
+STEP_PREFIX_PATTERN = re.compile(rb'^\{"id":"([^"\\]*)","timestamp":"[^"\\]*","type":"([^"\\]*)"')
+
+# ---------------------------------------------------------------------------
+
+class Layer:
+
+    # A signed layer of the record, with its position in the steps as a
+    # list of indexes, and the index of the layer which includes it.
+
+    __slots__ = ("index", "path", "parent", "serial", "sign_timestamp", "signer_info", "step_ids")
+
+    def __init__(self, index, path, parent, serial, sign_timestamp):
+        self.index = index
+        self.path = path
+        self.parent = parent
+        self.serial = serial
+        self.sign_timestamp = sign_timestamp
+        self.signer_info = None
+        self.step_ids = []
+
+
+class RecordView:
+
+    # Read only view of an encoded record which decodes steps only when they
+    # are asked for. A single pass over the raw structure indexes each step
+    # id to its layer and offset, reading just enough of each step to find
+    # its id and type.
+    #
+    # This view does not check signatures. If a VerificationResult for the
+    # record (from ParallelVerifier) is given, steps have the same
+    # _signature information as Record.decoded(), and can be found by
+    # signing member as well as by certificate serial.
+    #
+    # data attributes:
+    #   _layers -- list of Layer, outermost first
+    #   _index -- step id -> (layer index, offset within layer)
+    #   _types -- step type -> list of step ids, in record order
+    #   _decoded -- memo of step id -> decoded step
+
+    def __init__(self, encoded_record, verification=None, record_index=0):
+        self._record = encoded_record
+        self._layers = []
+        self._containers = []
+        self._index = {}
+        self._types = {}
+        self._decoded = {}
+        self._index_container(encoded_record["steps"], [], None)
+        if verification is not None:
+            for result in verification.layers_for_record(record_index):
+                if not result.valid():
+                    raise Exception("Record has a layer which failed verification: "+str(result.error))
+            signers = {tuple(r.path): r.signer_info for r in verification.layers_for_record(record_index)}
+            for layer in self._layers:
+                layer.signer_info = signers.get(tuple(layer.path))
+
+    def _index_container(self, container, path, parent):
+        *data, sig_block = container
+        container_format_version, serial, sign_timestamp, signature = sig_block
+        layer = Layer(len(self._layers), path, parent, serial, sign_timestamp)
+        self._layers.append(layer)
+        self._containers.append(container)
+        for offset, e in enumerate(data):
+            if not isinstance(e, str):
+                self._index_container(e, path + [offset], layer.index)
+            else:
+                step_id, step_type = self._read_id_and_type(e)
+                if step_id in self._index:
+                    raise Exception("Duplicate step id in record: "+step_id)
+                self._index[step_id] = (layer.index, offset)
+                layer.step_ids.append(step_id)
+                self._types.setdefault(step_type, []).append(step_id)
+
+    def _read_id_and_type(self, encoded_step):
+        match = STEP_PREFIX_PATTERN.match(base64.urlsafe_b64decode(encoded_step[:STEP_PREFIX_LENGTH]))
+        if match is not None:
+            return (match.group(1).decode("utf-8"), match.group(2).decode("utf-8"))
+        # Written some other way, so decode it all and keep the result
+        step = json.loads(base64.urlsafe_b64decode(encoded_step))
+        self._decoded[step["id"]] = step
+        return (step["id"], step["type"])
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, step_id):
+        return step_id in self._index
+
+    def ids(self):
+        return list(self._index.keys())
+
+    def types(self):
+        return list(self._types.keys())
+
+    def layers(self):
+        return list(self._layers)
+
+    def layer_for_step(self, step_id):
+        layer_index, offset = self._index[step_id]
+        return self._layers[layer_index]
+
+    def position_of(self, step_id):
+        # (path of the layer, offset of the step within the layer)
+        if step_id not in self._index:
+            raise Exception("No step with id "+step_id+" in record")
+        layer_index, offset = self._index[step_id]
+        return (list(self._layers[layer_index].path), offset)
+
+    def step(self, step_id):
+        if step_id not in self._index:
+            raise Exception("No step with id "+step_id+" in record")
+        step = self._decoded.get(step_id)
+        if step is None:
+            layer_index, offset = self._index[step_id]
+            step = json.loads(base64.urlsafe_b64decode(self._containers[layer_index][offset]))
+            self._decoded[step_id] = step
+        step = copy.deepcopy(step)
+        layer = self._layers[self._index[step_id][0]]
+        if layer.signer_info is not None:
+            step["_signature"] = {
+                "signed": layer.signer_info,
+                "includedBy": self._included_by(layer)
+            }
+        return step
+
+    def _included_by(self, layer):
+        included_by = []
+        while layer.parent is not None:
+            layer = self._layers[layer.parent]
+            included_by.append(layer.signer_info)
+        included_by.reverse()
+        return included_by
+
+    def steps(self, step_ids):
+        return list(map(self.step, step_ids))
+
+    def ids_of_type(self, step_type):
+        return list(self._types.get(step_type, []))
+
+    def steps_of_type(self, step_type):
+        return self.steps(self._types.get(step_type, []))
+
+    def origins(self):
+        return self.steps(self._record["origins"])
+
+    def ids_signed_by(self, signer):
+        # signer is a certificate serial, or a member URL if verified
+        ids = []
+        for layer in self._layers:
+            if layer.serial == signer or (layer.signer_info is not None and layer.signer_info.get("member") == signer):
+                ids.extend(layer.step_ids)
+        return ids
+
+    def steps_signed_by(self, signer):
+        return self.steps(self.ids_signed_by(signer))